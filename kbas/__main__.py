@@ -23,9 +23,8 @@ from time import strftime, gmtime
 from datetime import datetime
 import tempfile
 from bottle import Bottle, request, response, template, static_file
-from subprocess import call
 
-from ybd import app, cache
+from ybd import app, cache, utils
 
 bottle = Bottle()
 
@@ -92,8 +91,20 @@ class KeyedBinaryArtifactServer(object):
     def get_artifact(cache_id):
         f = os.path.join(cache_id, cache_id)
         app.config['downloads'] += 1
-        return static_file(f, root=app.config['artifact-dir'], download=True,
-                           mimetype='application/x-tar')
+        # static_file answers Range requests, so clients can resume
+        result = static_file(f, root=app.config['artifact-dir'], download=True,
+                             mimetype='application/x-tar')
+        if result.status_code in [200, 206]:
+            result.set_header('X-Checksum-%s' % cache.algorithm(),
+                              cache.check(cache_id))
+        return result
+
+    @bottle.post('/query')
+    def query():
+        keys = request.forms.get('keys', '').split()
+        available = [key for key in keys if os.path.isfile(
+            os.path.join(app.config['artifact-dir'], key, key))]
+        return {'available': available}
 
     @bottle.get('/')
     @bottle.get('/status')
@@ -152,12 +163,10 @@ class KeyedBinaryArtifactServer(object):
                 with open(artifact, "w") as f:
                     f.write(upload.value)
 
-            if call(['tar', 'tf', artifact]):
+            if utils.untar(artifact, tmpdir, ['t']):
                 app.log('UPLOAD', 'ERROR: not a valid tarfile:', artifact)
                 raise
-            checksum = cache.md5(artifact)
-            with open(artifact + '.md5', "a") as f:
-                f.write(checksum)
+            cache.checksum(artifact)
             shutil.move(tmpdir, os.path.join(app.config['artifact-dir'],
                                              cache_id))
             response.status = 201  # success!
@@ -16,10 +16,16 @@
 import app
 import assembly
 import cache
+import cas
+import coordinator
 import defaults
+import history
 import morphs
 import pots
 import deployment
 import repos
+import resources
 import sandbox
+import scheduler
+import usage
 import utils
@@ -20,16 +20,20 @@
 import os
 import sys
 import fcntl
+import tempfile
 import app
-from app import cleanup, config, log, RetryException, setup, spawn, timer
-from assembly import compose
+from app import cleanup, config, log, setup, spawn, timer
 from deployment import deploy
 from pots import Pots
 from concourse import Pipeline
 import cache
+import cas
+from coordinator import coordinate, work
 from release_note import do_release_note
+from scheduler import graph, schedule
 import sandbox
 import sandboxlib
+import usage
 import argparse
 import yaml
 
@@ -57,11 +61,19 @@ parser = argparse.ArgumentParser(description=description)
 parser.add_argument('-m', '--mode', type=str, default=None,
                     choices=['parse-only', 'keys-only', 'no-build', 'normal'],
                     help='Operation mode')
+parser.add_argument('-k', '--keep-going', action='store_true',
+                    help='Keep building whatever does not depend on a failure')
+parser.add_argument('--check-blobs', action='store_true',
+                    help='Check all deduplicated files for unused ones')
 parser.add_argument('target', help='The target definition')
 parser.add_argument('arch', help='The target architecture')
 args = parser.parse_args()
 
 setup(sys.argv[0], args.target, args.arch, args.mode, original_cwd)
+if args.keep_going:
+    config['keep-going'] = True
+if args.check_blobs:
+    config['check-blobs'] = True
 cleanup(config['tmp'])
 
 with timer('TOTAL'):
@@ -80,6 +92,7 @@ with timer('TOTAL'):
 
     with timer('CACHE-KEYS', 'cache-key calculations'):
         cache.cache_key(target)
+    cache.protect(config['keys'])
 
     app.defs.prune()
     app.defs.save(os.path.basename(config['target']) + '.yml')
@@ -92,11 +105,18 @@ with timer('TOTAL'):
         log('ARCH', 'No definitions for', config['arch'], exit=True)
 
     app.defs.save_trees()
+    cache.save_memos()
     if config.get('mode', 'normal') == 'keys-only':
         write_cache_key()
         os._exit(0)
 
     cache.cull(config['artifacts'])
+    app.reap(lambda: cache.cull(config['artifacts'], exit=False,
+                                margin=config.get('cull-margin', 2)),
+             cas.reclaim)
+    if not config.get('coordinator-port'):
+        nodes, order = graph(target)
+        cache.prefetch([app.defs.get(path) for path in order])
 
     sandbox.executor = sandboxlib.executor_for_platform()
     log(config['target'], 'Sandbox using %s' % sandbox.executor)
@@ -104,23 +124,30 @@ with timer('TOTAL'):
         log(config['target'], 'WARNING: using chroot is less safe ' +
             'than using linux-user-chroot')
 
-    if 'instances' in config:
+    if config.get('keep-going'):
+        # failures are recorded here, so that all instances know about them
+        config['failed-dir'] = tempfile.mkdtemp(dir=config['tmp'],
+                                                prefix='failed.')
+
+    if 'instances' in config and not config.get('coordinator-port'):
         spawn()
 
-    while True:
-        try:
-            compose(target)
-            break
-        except KeyboardInterrupt:
-            log(target, 'Interrupted by user')
-            os._exit(1)
-        except RetryException:
-            pass
-        except:
-            import traceback
-            traceback.print_exc()
-            log(target, 'Exiting: uncaught exception')
-            os._exit(1)
+    try:
+        if config.get('coordinator-port'):
+            coordinate(target)
+        elif config.get('coordinator-url'):
+            work(target)
+        else:
+            schedule(target)
+    except KeyboardInterrupt:
+        log(target, 'Interrupted by user')
+        os._exit(1)
+    except:
+        import traceback
+        traceback.print_exc()
+        log(target, 'Exiting: uncaught exception')
+        os._exit(1)
+    usage.flush()
 
     if config.get('reproduce'):
         log('REPRODUCED',
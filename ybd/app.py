@@ -16,11 +16,14 @@
 
 import contextlib
 import datetime
+import errno
 import os
 import fcntl
 import re
 import shutil
 import sys
+import tempfile
+import time
 import warnings
 import yaml
 from multiprocessing import cpu_count, Value, Lock
@@ -34,22 +37,9 @@ config = {}
 defs = {}
 
 
-class RetryException(Exception):
-    def __init__(self, dn):
-        if config.get('last-retry-dn') != dn:
-            log(dn, 'Already assembling, so wait/retry', verbose=True)
-        if config.get('last-retry-time'):
-            wait = datetime.datetime.now() - config.get('last-retry-time')
-            if wait.seconds < 1:
-                with open(lockfile(dn), 'r') as L:
-                    call(['flock', '--shared', '--timeout',
-                          config.get('timeout', '60'), str(L.fileno())])
-                log(dn, 'Finished wait loop', verbose=True)
-        config['last-retry-time'] = datetime.datetime.now()
-        config['last-retry-dn'] = dn
-        for dirname in config['sandboxes']:
-            remove_dir(dirname)
-        config['sandboxes'] = []
+class BuildError(Exception):
+    '''A build failed, but we are keeping going with other builds.'''
+    pass
 
 
 # Code taken from Eli Bendersky's example at
@@ -63,6 +53,22 @@ class Counter(object):
         with self.lock:
             self.val.value += 1
 
+    def decrement(self):
+        with self.lock:
+            self.val.value -= 1
+
+    def reserve(self, amount, limit):
+        '''Add amount if the total stays within limit, or was zero.'''
+        with self.lock:
+            if self.val.value > 0 and self.val.value + amount > limit:
+                return False
+            self.val.value += amount
+            return True
+
+    def release(self, amount):
+        with self.lock:
+            self.val.value -= amount
+
     def get(self):
         with self.lock:
             return self.val.value
@@ -136,7 +142,6 @@ def setup(program, target, arch, mode, original_cwd=""):
     config['filename'] = os.path.basename(target)
     config['target'] = os.path.basename(os.path.splitext(target)[0])
     config['arch'] = arch
-    config['sandboxes'] = []
     config['overlaps'] = []
     config['new-overlaps'] = []
 
@@ -212,9 +217,6 @@ def setup(program, target, arch, mode, original_cwd=""):
     # the right flag in an environment variable.
     os.environ['GIT_NO_REPLACE_OBJECTS'] = '1'
 
-    if 'max-jobs' not in config:
-        config['max-jobs'] = cpu_count()
-
     if 'instances' not in config:
         # based on some testing (mainly on AWS), maximum effective
         # max-jobs value seems to be around 8-10 if we have enough cores
@@ -222,11 +224,16 @@ def setup(program, target, arch, mode, original_cwd=""):
         # FIXME: more testing :)
         if cpu_count() >= 10:
             config['instances'] = 1 + (cpu_count() / 10)
-            config['max-jobs'] = cpu_count() / config['instances']
 
     config['pid'] = os.getpid()
     config['counter'] = Counter()
-    log('SETUP', 'Max-jobs is set to', config['max-jobs'])
+    config['building'] = Counter()
+    config['memory'] = Counter()
+    if config.get('max-jobs'):
+        log('SETUP', 'Max-jobs is set to', config['max-jobs'])
+    else:
+        log('SETUP', 'Max-jobs will be set for each build, up to',
+            cpu_count())
 
 
 def load_configs(config_files):
@@ -256,13 +263,10 @@ def cleanup(tmpdir):
         log('SETUP', 'Trying cleanup for', tmpdir)
         with open(os.path.join(tmpdir, 'lock'), 'w') as tmp_lock:
             fcntl.flock(tmp_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            to_delete = os.listdir(tmpdir)
-            fcntl.flock(tmp_lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
-            if os.fork() == 0:
-                for dirname in to_delete:
+            for dirname in os.listdir(tmpdir):
+                if dirname not in ['lock', 'trash', 'snapshots']:
                     remove_dir(os.path.join(tmpdir, dirname))
-                log('SETUP', 'Cleanup successful for', tmpdir)
-                sys.exit(0)
+            log('SETUP', 'Cleanup successful for', tmpdir)
     except IOError:
         log('SETUP', 'WARNING: no cleanup for', tmpdir)
 
@@ -270,11 +274,135 @@ def cleanup(tmpdir):
 def remove_dir(tmpdir):
     if (os.path.dirname(tmpdir) == config['tmp']) and os.path.isdir(tmpdir):
         try:
-            shutil.rmtree(tmpdir)
+            trash(tmpdir)
         except:
             log('SETUP', 'WARNING: unable to remove', tmpdir)
 
 
+def trash(path, size=0):
+    '''Hand path over to the reaper, which deletes it in the background.
+
+    Renaming is quick, so builds don't wait for big trees to be deleted.
+    If path is on another filesystem from tmp we have to delete it here.
+    If the caller knows how many bytes deleting path will free, size is
+    kept in the name in trash, for free_space().
+
+    '''
+    trashdir = os.path.join(config['tmp'], 'trash')
+    if not os.path.isdir(trashdir):
+        try:
+            os.makedirs(trashdir)
+        except OSError:
+            pass
+    try:
+        os.rename(path, tempfile.mktemp(dir=trashdir, prefix='%d.' % size))
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.rmtree(path)
+
+
+def free_space(path):
+    '''Return the free bytes on the filesystem of path.
+
+    Whatever is in trash on the same filesystem counts as free too, since
+    the reaper is about to delete it, as far as trash() was told its size.
+
+    '''
+    stat = os.statvfs(path)
+    free = stat.f_frsize * stat.f_bavail
+    trashdir = os.path.join(config['tmp'], 'trash')
+    try:
+        if os.stat(trashdir).st_dev != os.stat(path).st_dev:
+            return free
+        names = os.listdir(trashdir)
+    except OSError:
+        return free
+    for name in names:
+        try:
+            free += int(name.split('.')[0])
+        except ValueError:
+            pass
+    return free
+
+
+@contextlib.contextmanager
+def nothing():
+    yield
+
+
+def reap(cull=None, reclaim=nothing, interval=1):
+    '''Fork a process which deletes everything handed to trash().
+
+    The reaper runs at idle I/O priority, so deletion only uses disk
+    bandwidth that builds don't need. If cull is given, the reaper also
+    calls it whenever free space in artifacts falls to within cull-margin
+    of min-gigabytes, rather than waiting for the next run to free space.
+    cull must not exit, since the reaper has to keep going. Each time the
+    trash is emptied, it is emptied inside the reclaim() context, so
+    reclaim can free anything which was waiting for the trash to be deleted.
+
+    The reaper exits when our process has gone and the trash is empty.
+    Only one reaper works on the trash at a time.
+
+    '''
+    trashdir = os.path.join(config['tmp'], 'trash')
+    if not os.path.isdir(trashdir):
+        os.makedirs(trashdir)
+    parent = os.getpid()
+    if os.fork() != 0:
+        return
+
+    # we are a copy of ybd, so must never return into it
+    try:
+        reaper(trashdir, parent, cull, reclaim, interval)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+    finally:
+        os._exit(0)
+
+
+def reaper(trashdir, parent, cull, reclaim, interval):
+    os.nice(10)
+    with open(os.devnull, 'w') as fnull:
+        call(['ionice', '-c', '3', '-p', str(os.getpid())],
+             stdout=fnull, stderr=fnull)
+    checked = 0
+    with open(os.path.join(trashdir, '.lock'), 'w') as trash_lock:
+        while True:
+            try:
+                fcntl.flock(trash_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                with reclaim():
+                    for name in os.listdir(trashdir):
+                        path = os.path.join(trashdir, name)
+                        if name.startswith('.'):
+                            continue
+                        if os.path.isdir(path) and not os.path.islink(path):
+                            shutil.rmtree(path, ignore_errors=True)
+                        elif os.path.lexists(path):
+                            os.remove(path)
+                fcntl.flock(trash_lock, fcntl.LOCK_UN)
+            except (IOError, OSError):
+                pass  # another reaper is busy, or got there first
+
+            if cull and time.time() - checked > 10 * interval:
+                checked = time.time()
+                free = free_space(config['artifacts']) / 1000000000
+                minimum = config.get('min-gigabytes', 10)
+                if minimum and free < minimum + config.get('cull-margin', 2):
+                    try:
+                        cull()
+                    except Exception as e:
+                        log('SETUP', 'WARNING: reaper unable to cull:', e)
+
+            if os.getppid() != parent and not [name for name in
+                                               os.listdir(trashdir)
+                                               if not name.startswith('.')]:
+                break
+            time.sleep(interval)
+
+
 @contextlib.contextmanager
 def chdir(dirname=None):
     currentdir = os.getcwd()
@@ -303,7 +431,11 @@ def timer(dn, message=''):
 
 def elapsed(starttime):
     td = datetime.datetime.now() - starttime
-    hours, remainder = divmod(int(td.total_seconds()), 60*60)
+    return duration(td.total_seconds())
+
+
+def duration(seconds):
+    hours, remainder = divmod(int(seconds), 60*60)
     minutes, seconds = divmod(remainder, 60)
     return "%02d:%02d:%02d" % (hours, minutes, seconds)
 
@@ -15,16 +15,20 @@
 # =*= License: GPL-2 =*=
 
 import os
-import random
 import contextlib
 import fcntl
 import errno
+import hashlib
+import tempfile
+import time
 
 import app
 from app import config, timer, elapsed
-from app import log, lockfile, RetryException
-from cache import cache, cache_key, get_cache, get_remote
+from app import log, lockfile
+from cache import cache, cache_key, get_cache, get_remote, upload
+import history
 import repos
+import resources
 import sandbox
 import datetime
 from splitting import write_metadata, install_split_artifacts
@@ -49,29 +53,34 @@ def compose(dn):
 
     log(dn, "Composing", dn['name'], verbose=True)
 
-    # if we have a kbas, look there to see if this component exists
-    if config.get('kbas-url') and not config.get('reproduce'):
-        with claim(dn):
+    with claim(dn):
+        # another instance may have created dn while we waited for the claim
+        if get_cache(dn):
+            return cache_key(dn)
+
+        # if we have a kbas, look there to see if this component exists
+        if config.get('kbas-url') and not config.get('reproduce'):
             if get_remote(dn):
                 config['counter'].increment()
                 return cache_key(dn)
 
-    # we only work with user-specified arch
-    if 'arch' in dn and dn['arch'] != config['arch']:
-        return None
+        # we only work with user-specified arch
+        if 'arch' in dn and dn['arch'] != config['arch']:
+            return None
 
-    # Create composite components (strata, systems, clusters)
-    systems = dn.get('systems', [])
-    shuffle(systems)
-    for system in systems:
-        for s in system.get('subsystems', []):
-            subsystem = app.defs.get(s['path'])
-            compose(subsystem)
-        compose(system['path'])
+        # Create composite components (strata, systems, clusters)
+        for system in dn.get('systems', []):
+            for s in system.get('subsystems', []):
+                subsystem = app.defs.get(s['path'])
+                compose(subsystem)
+            compose(system['path'])
 
-    with sandbox.setup(dn):
-        install_contents(dn)
-        build(dn)     # bring in 'build-depends', and run make
+        with sandbox.setup(dn):
+            if dn.get('contents'):
+                with history.timer(dn, 'staging'):
+                    install_contents(dn)
+                sandbox.log_staging(dn)
+            build(dn)     # bring in 'build-depends', and run make
 
     return cache_key(dn)
 
@@ -84,11 +93,9 @@ def install_contents(dn, contents=None):
 
     log(dn, 'Installing contents\n', contents, verbose=True)
 
-    shuffle(contents)
     for it in contents:
         item = app.defs.get(it)
-        if os.path.exists(os.path.join(dn['sandbox'],
-                                       'baserock', item['name'] + '.meta')):
+        if sandbox.installed(dn, item):
             # content has already been installed
             log(dn, 'Already installed', item['name'], verbose=True)
             continue
@@ -111,13 +118,13 @@ def install_dependencies(dn, dependencies=None):
 
     if dependencies is None:
         dependencies = dn.get('build-depends', [])
+        if config.get('sandbox-snapshots'):
+            install_snapshot(dn)
 
     log(dn, 'Installing dependencies\n', dependencies, verbose=True)
-    shuffle(dependencies)
     for it in dependencies:
         dependency = app.defs.get(it)
-        if os.path.exists(os.path.join(dn['sandbox'], 'baserock',
-                                       dependency['name'] + '.meta')):
+        if sandbox.installed(dn, dependency):
             # dependency has already been installed
             log(dn, 'Already did', dependency['name'], verbose=True)
             continue
@@ -134,6 +141,44 @@ def install_dependencies(dn, dependencies=None):
         sandbox.list_files(dn)
 
 
+def install_snapshot(dn):
+    '''Install the strata which dn build-depends on from a snapshot.
+
+    Every chunk in a stratum build-depends on the stratum's build-depends,
+    so we stage those once into a snapshot, keyed by their cache-keys, and
+    clone it into the sandbox of each chunk. The chunk's other dependencies
+    are then installed on top as usual.
+
+    '''
+    if sandbox.use_overlayfs(dn) or \
+            dn.get('build-mode', 'staging') != 'staging':
+        return
+
+    strata = []
+    for it in dn.get('build-depends', []):
+        if app.defs.get(it).get('kind') != 'stratum':
+            break
+        strata.append(it)
+    if strata == []:
+        return
+
+    # the order matters, where strata overlap
+    key = hashlib.sha256(' '.join(cache_key(it) for it in strata)).hexdigest()
+    if sandbox.restore(dn, key):
+        return
+
+    staging = dict(dn, sandbox=tempfile.mkdtemp(), staged=(0, 0))
+    before = len(config['new-overlaps'])
+    install_dependencies(staging, strata)
+    overlaps = config['new-overlaps'][before:]
+    del config['new-overlaps'][before:]
+    sandbox.snapshot(staging, key, overlaps)
+
+    # if we can't clone it, install_dependencies() installs them anyway
+    dn['staged'] = (0, staging['staged'][1])
+    sandbox.restore(dn, key)
+
+
 def build(dn):
     '''Create an artifact for a single component and add it to the cache'''
 
@@ -141,12 +186,18 @@ def build(dn):
         return
 
     with claim(dn):
+        if get_cache(dn):
+            return
         if dn.get('kind', 'chunk') == 'chunk':
-            install_dependencies(dn)
-        with timer(dn, 'build of %s' % dn['cache']):
+            with history.timer(dn, 'staging'):
+                install_dependencies(dn)
+                sandbox.mount(dn)
+            sandbox.log_staging(dn)
+        with resources.admit(dn), timer(dn, 'build of %s' % dn['cache']):
             run_build(dn)
+        sandbox.unmount(dn)
 
-        with timer(dn, 'artifact creation'):
+        with timer(dn, 'artifact creation'), history.timer(dn, 'archive'):
 
             if dn.get('kind', 'chunk') == 'system':
                 install_split_artifacts(dn)
@@ -154,6 +205,8 @@ def build(dn):
             write_metadata(dn)
             cache(dn)
 
+        upload(dn)
+
 
 def run_build(dn):
     ''' This is where we run ./configure, make, make install (for example).
@@ -191,32 +244,79 @@ def run_build(dn):
         time_elapsed = elapsed(dn['start-time'])
         logfile.write('Elapsed_time: %s\n' % time_elapsed)
 
+    seconds = (datetime.datetime.now() - dn['start-time']).total_seconds()
+    history.record(dn, 'build', seconds)
+
 
-def shuffle(contents):
-    if config.get('instances', 1) > 1:
-        random.seed(datetime.datetime.now())
-        random.shuffle(contents)
+# cache keys of the components this fork currently has a claim on
+claims = set()
 
 
 @contextlib.contextmanager
-def claim(dn):
-    with open(lockfile(dn), 'a') as L:
-        try:
-            fcntl.flock(L, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except Exception as e:
-            if e.errno in (errno.EACCES, errno.EAGAIN):
+def claim(dn, wait=True):
+    '''Lock dn so that no other instance assembles it at the same time.
+
+    If another instance already has the lock, we sleep until it lets go,
+    by which time the artifact usually exists - so callers should check
+    get_cache() again. If wait is False we yield False straight away, so
+    the caller can find something else to do. Claims are re-entrant within
+    an instance, so the scheduler can claim a component and then compose it.
+
+    '''
+    if cache_key(dn) in claims:
+        yield True
+        return
+
+    while True:
+        with open(lockfile(dn), 'a') as L:
+            try:
+                fcntl.flock(L, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except Exception as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    log(dn, 'ERROR: surprise exception in assembly', '')
+                    import traceback
+                    traceback.print_exc()
+                    log(dn, 'Sandbox debris at', dn.get('sandbox'), exit=True)
                 # flock() will report EACCESS or EAGAIN when the lock fails.
-                raise RetryException(dn)
-            else:
-                log(dn, 'ERROR: surprise exception in assembly', '')
-                import traceback
-                traceback.print_exc()
-                log(dn, 'Sandbox debris at', dn['sandbox'], exit=True)
+                if not wait:
+                    yield False
+                    return
+                log(dn, 'Waiting for another instance to finish', verbose=True)
+                wait_for_lock(dn, L)
+
+            # the previous holder removes the lockfile when it finishes, so
+            # check that what we have locked is still the lockfile
+            try:
+                if os.fstat(L.fileno()).st_ino != os.stat(L.name).st_ino:
+                    continue
+            except OSError:
+                continue
+
+            claims.add(cache_key(dn))
+            try:
+                yield True
+            finally:
+                claims.discard(cache_key(dn))
+                if os.path.isfile(lockfile(dn)):
+                    os.remove(lockfile(dn))
+            return
+
+
+def wait_for_lock(dn, lock, interval=0.5):
+    '''Wait up to config['timeout'] seconds for an exclusive lock.'''
+
+    deadline = time.time() + int(config.get('timeout', 60))
+    while True:
         try:
-            yield
-        finally:
-            if os.path.isfile(lockfile(dn)):
-                os.remove(lockfile(dn))
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except IOError as e:
+            if e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+        if time.time() > deadline:
+            log(dn, 'Timed out waiting for another instance on',
+                lock.name, exit=True)
+        time.sleep(interval)
 
 
 def get_build_commands(dn):
@@ -16,16 +16,21 @@
 
 import requests
 
+import errno
 import hashlib
 import json
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
-from subprocess import call
 
 import app
-from repos import get_repo_url, get_tree
+import cas
+import history
+from repos import get_repo_url, get_tree, resolve_trees
 import utils
 import tempfile
+import time
+import usage
 import yaml
 import re
 
@@ -50,18 +55,28 @@ def cache_key(dn):
                     app.config['arch'])
         return False
 
+    if app.config.get('mode', 'normal') in ['keys-only', 'normal']:
+        if not _resolving:
+            return resolve_refs(dn)
+
     dn['cache'] = 'calculating'
 
     key = 'no-build'
     if app.config.get('mode', 'normal') in ['keys-only', 'normal']:
+        memo = memo_key(dn)
+        if memo in memos():
+            key, tree, sha = memos()[memo][:3]
+            if dn.get('repo') and not dn.get('tree'):
+                dn['tree'], dn['sha'] = tree, sha
         if dn.get('repo'):
             if not dn.get('tree'):
                 dn['tree'], dn['sha'] = get_tree(dn)
             if not dn.get('repourl'):
                 dn['repourl'] = get_repo_url(dn.get('repo'))
-        factors = hash_factors(dn)
-        factors = json.dumps(factors, sort_keys=True).encode('utf-8')
-        key = hashlib.sha256(factors).hexdigest()
+        if memo not in memos():
+            key = hash_key(dn)
+        if memo:
+            memos()[memo] = [key, dn.get('tree'), dn.get('sha'), time.time()]
 
     dn['cache'] = dn['name'] + "." + key
 
@@ -87,17 +102,273 @@ def cache_key(dn):
     return dn['cache']
 
 
+def protect(keys):
+    '''Make sure cull() doesn't remove the artifacts for keys during this run.
+
+    cull() runs in the reaper and in other runs of ybd too, which can't see
+    our config['keys'], so keys are listed in tmp/keys/<pid of this run>,
+    once all the cache-keys are known, and again for each rekey().
+
+    '''
+    keysdir = os.path.join(app.config['tmp'], 'keys')
+    try:
+        os.makedirs(keysdir)
+    except OSError:
+        pass
+    with open(os.path.join(keysdir, str(app.config['pid'])), 'a') as f:
+        f.write(''.join(key + '\n' for key in keys))
+
+
+def protected():
+    '''Return the keys which runs of ybd that are still going are using.'''
+
+    keys = set(app.config.get('keys', []))
+    keysdir = os.path.join(app.config['tmp'], 'keys')
+    if not os.path.isdir(keysdir):
+        return keys
+    for name in os.listdir(keysdir):
+        try:
+            os.kill(int(name), 0)
+        except ValueError:
+            continue
+        except OSError as e:
+            if e.errno != errno.EPERM:
+                continue    # that run has finished
+        try:
+            with open(os.path.join(keysdir, name)) as f:
+                keys.update(f.read().split())
+        except IOError:
+            pass
+    return keys
+
+
+_memos = None
+_resolving = False
+volatile = ['cache', 'tree', 'sha', 'repourl', 'tried']
+
+
+def dependencies(dn):
+    '''Return the paths of everything the cache-key for dn depends on.'''
+
+    paths = list(dn.get('build-depends', []))
+    paths += [factor.keys()[0] for factor in dn.get('contents', [])]
+    for system in dn.get('systems', []):
+        for subsystem in system.get('subsystems', []):
+            paths.append(subsystem.get('path', 'BROKEN'))
+        paths.append(system.get('path', 'BROKEN'))
+    return paths
+
+
+def resolve_refs(target):
+    '''Calculate the cache-keys for target and its dependencies in waves.
+
+    Each wave is the definitions whose dependencies all have cache-keys. Only
+    the ones we don't remember a cache-key for need their git refs resolved,
+    and they are resolved together by resolve_trees() before being keyed.
+
+    '''
+    global _resolving
+    pending, paths = {}, [target['path']]
+    while paths:
+        dn = app.defs.get(paths.pop())
+        if dn['path'] not in pending and not dn.get('cache'):
+            pending[dn['path']] = dn
+            paths += dependencies(dn)
+
+    _resolving, count = True, 0
+    try:
+        while pending:
+            ready = [dn for dn in pending.values()
+                     if not any(path in pending for path in dependencies(dn))]
+            if ready == []:
+                break    # a recursion loop, which cache_key() reports
+            count += resolve_trees(
+                [dn for dn in ready if dn.get('repo') and not dn.get('tree')
+                 and dn.get('arch', app.config['arch']) == app.config['arch']
+                 and memo_key(dn) not in memos()])
+            for dn in ready:
+                cache_key(dn)
+                del pending[dn['path']]
+        if count:
+            app.log('CACHE-KEYS', 'Resolved %s refs from git mirrors' % count)
+        return cache_key(target)
+    finally:
+        _resolving = False
+
+
+def memos():
+    '''Return the cache-keys we remember from previous runs.'''
+
+    global _memos
+    if _memos is None:
+        _memos = {}
+        try:
+            with open(os.path.join(app.config['artifacts'],
+                                   '.cache-keys')) as f:
+                _memos = json.load(f)
+        except (IOError, ValueError):
+            pass
+    return _memos
+
+
+def save_memos(limit=20000):
+    '''Save cache-keys for next time, keeping the most recently used.'''
+
+    if _memos is None:
+        return
+    keep = sorted(_memos.items(), key=lambda item: item[1][3])[-limit:]
+    tempfile.tempdir = app.config['tmp']
+    fd, tmpfile = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        json.dump(dict(keep), f)
+    shutil.move(tmpfile, os.path.join(app.config['artifacts'], '.cache-keys'))
+
+
+def memo_key(dn):
+    '''Return a hash of everything which determines the cache-key for dn.
+
+    This covers the definition itself, the hash factors of its dependencies
+    and the key_settings() that hash_factors() uses. A definition built
+    from a branch (rather than a sha) can change without any of these
+    changing, so it has no memo_key and we always calculate its cache-key.
+
+    '''
+    if dn.get('repo'):
+        if not re.match('^[0-9a-f]{40}$', str(dn.get('ref'))):
+            return None
+        track = app.config.get('track-branches')
+        if dn.get('unpetrify-ref') and track:
+            if track is True or dn['path'] in track:
+                return None
+
+    factors = {'definition': {k: v for k, v in dn.items()
+                              if k not in volatile},
+               'dependencies': {}}
+    for path in dependencies(dn):
+        factors['dependencies'][path] = dependency_factor(path)
+
+    factors['settings'] = key_settings()
+    factors['my-version'] = app.config.get('my-version')
+    factors['build-steps'] = app.defs.defaults.build_steps
+    factors['build-systems'] = app.defs.defaults.build_systems
+
+    factors = json.dumps(factors, sort_keys=True, default=str)
+    return hashlib.sha256(factors.encode('utf-8')).hexdigest()
+
+
+def key_settings():
+    '''Return the settings which cache-keys depend on.
+
+    hash_factors() only reads settings from here, so memo_key() can't miss
+    one when a new setting is made part of the cache-key.
+
+    '''
+    names = ['arch', 'artifact-compression', 'artifact-version',
+             'default-splits', 'early-cutoff']
+    return {name: app.config[name] for name in names if name in app.config}
+
+
+def hash_key(dn):
+    factors = hash_factors(dn)
+    factors = json.dumps(factors, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(factors).hexdigest()
+
+
+def rekey(dn):
+    '''Recalculate the cache-key for dn, once its dependencies are built.
+
+    With early-cutoff, the cache-key depends on what the dependencies
+    produced. Until they are built we can only use their cache-keys, so
+    we need to recalculate before checking whether dn is already cached.
+
+    '''
+    if not app.config.get('early-cutoff') or not dn.get('cache'):
+        return
+    if app.config.get('mode', 'normal') not in ['keys-only', 'normal']:
+        return
+
+    key = dn['name'] + "." + hash_key(dn)
+    if key != dn['cache']:
+        app.log(dn, 'Cache-key from the outputs of dependencies is', key)
+        dn['cache'] = key
+        app.config['keys'] += [key]
+        protect([key])
+
+
+def dependency_factor(path):
+    '''Return the hash factor for a dependency.
+
+    Normally this is just the dependency's cache-key. With early-cutoff we
+    use the hash of the files it produced, if we have it, so that rebuilding
+    a dependency which produces identical files doesn't cause a rebuild.
+
+    '''
+    key = cache_key(path)
+    if not app.config.get('early-cutoff') or key is False:
+        return key
+    return output_hash(app.defs.get(path)) or key
+
+
+def output_hash(dn):
+    '''Return a hash of the files in the artifact for dn, or None.
+
+    For a chunk this is the hash of its files, remembered in
+    artifacts/.outputs so we only calculate it once per artifact. Metadata
+    in baserock/ includes the cache-key, so it is not part of the hash.
+
+    Strata and systems are assembled from their contents, so we hash what
+    their contents produced, along with the rest of their hash_factors()
+    except build-depends, which don't end up in the artifact. Their
+    artifacts can't be hashed directly: a stratum has only metadata, and a
+    system tarball includes its cache-key.
+
+    '''
+    artifact = get_cache(dn)
+    if not artifact:
+        return None
+
+    if dn.get('kind', 'chunk') != 'chunk':
+        factors = hash_factors(dn)
+        for path in dn.get('build-depends', []):
+            factors.pop(path, None)
+        factors = json.dumps(factors, sort_keys=True).encode('utf-8')
+        return 'output:' + hashlib.sha256(factors).hexdigest()
+
+    outputs = os.path.join(app.config['artifacts'], '.outputs')
+    hashfile = os.path.join(outputs, dn['cache'])
+    if os.path.exists(hashfile):
+        with open(hashfile) as f:
+            return f.read()
+
+    if get_unpacked(dn):
+        digest = utils.tree_hash(get_unpacked(dn), ['baserock'])
+    else:
+        digest = checksum(artifact)
+    digest = 'output:' + digest
+
+    if not os.path.isdir(outputs):
+        os.makedirs(outputs)
+    tempfile.tempdir = app.config['tmp']
+    fd, tmpfile = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        f.write(digest)
+    shutil.move(tmpfile, hashfile)
+    return digest
+
+
 def hash_factors(dn):
-    hash_factors = {'arch': app.config['arch']}
+    settings = key_settings()
+    hash_factors = {'arch': settings['arch']}
 
     for factor in dn.get('build-depends', []):
-        hash_factors[factor] = cache_key(factor)
+        hash_factors[factor] = dependency_factor(factor)
 
     for factor in dn.get('contents', []):
-        hash_factors[factor.keys()[0]] = cache_key(factor.keys()[0])
+        path = factor.keys()[0]
+        hash_factors[path] = dependency_factor(path)
 
     relevant_factors = ['tree', 'submodules'] + app.defs.defaults.build_steps
-    if app.config.get('artifact-version', False) not in range(0, 6):
+    if settings.get('artifact-version', False) not in range(0, 6):
         relevant_factors += ['devices']
 
     for factor in relevant_factors:
@@ -105,12 +376,16 @@ def hash_factors(dn):
             hash_factors[factor] = dn[factor]
 
     if dn.get('kind') == 'system':
-        if app.config.get('default-splits', []) != []:
-            hash_factors['splits'] = app.config.get('default-splits')
+        if settings.get('default-splits', []) != []:
+            hash_factors['splits'] = settings.get('default-splits')
+        if settings.get('artifact-version', 0) not in range(0, 9):
+            # systems are assembled by copy_all_files(), which copies
+            # symlinks as symlinks, where copy_fs() copied what they point to
+            hash_factors['symlinks'] = 'copied'
 
     def hash_system_recursively(system):
         factor = system.get('path', 'BROKEN')
-        hash_factors[factor] = cache_key(factor)
+        hash_factors[factor] = dependency_factor(factor)
         for subsystem in system.get('subsystems', []):
             hash_system_recursively(subsystem)
 
@@ -118,10 +393,10 @@ def hash_factors(dn):
         for system in dn.get('systems', []):
             hash_system_recursively(system)
 
-    if app.config.get('artifact-version', False):
-        hash_factors['artifact-version'] = app.config.get('artifact-version')
+    if settings.get('artifact-version', False):
+        hash_factors['artifact-version'] = settings.get('artifact-version')
 
-        if app.config.get('artifact-version', 0) in range(0, 2):
+        if settings.get('artifact-version', 0) in range(0, 2):
             # this way, any change to any build-system invalidates all caches
             hash_factors['default-build-systems'] = \
                 app.defs.defaults.build_systems
@@ -130,17 +405,24 @@ def hash_factors(dn):
             hash_factors['default-build-systems'] = \
                 app.defs.defaults.build_systems.get(dn.get('build-system',
                                                     'manual'))
-            if (app.config.get('default-splits', []) != [] and
+            if (settings.get('default-splits', []) != [] and
                     dn.get('kind') == 'system'):
-                hash_factors['default-splits'] = app.config['default-splits']
+                hash_factors['default-splits'] = settings['default-splits']
 
-        if app.config.get('artifact-version', 0) not in range(0, 7):
+        if settings.get('artifact-version', 0) not in range(0, 7):
             if dn.get('max-jobs'):
                 if dn['max-jobs'] == 1:
                     hash_factors['max-jobs'] = 'single'
                 else:
                     hash_factors['max-jobs'] = 'parallel'
 
+    if settings.get('early-cutoff'):
+        hash_factors['early-cutoff'] = True
+
+    compression = settings.get('artifact-compression', 'gzip')
+    if compression != 'gzip' and dn.get('kind', 'chunk') != 'system':
+        hash_factors['artifact-compression'] = compression
+
     return hash_factors
 
 
@@ -151,26 +433,25 @@ def cache(dn):
     tempfile.tempdir = app.config['tmp']
     tmpdir = tempfile.mkdtemp()
     cachefile = os.path.join(tmpdir, cache_key(dn))
+    digest = new_checksum()
     if dn.get('kind') == "system":
         utils.hardlink_all_files(dn['install'], dn['sandbox'])
-        shutil.rmtree(dn['checkout'])
+        app.trash(dn['checkout'])
         utils.set_mtime_recursively(dn['install'])
-        utils.make_deterministic_tar_archive(cachefile, dn['install'])
+        utils.make_deterministic_tar_archive(cachefile, dn['install'], digest)
         shutil.move('%s.tar' % cachefile, cachefile)
     else:
         utils.set_mtime_recursively(dn['install'])
-        utils.make_deterministic_gztar_archive(cachefile, dn['install'])
-        shutil.move('%s.tar.gz' % cachefile, cachefile)
+        utils.make_deterministic_archive(
+            cachefile, dn['install'],
+            app.config.get('artifact-compression', 'gzip'), digest)
+        # the install tree is exactly what the archive would unpack to
+        shutil.move(dn['install'], cachefile + '.unpacked')
+    write_checksum(cachefile, digest.hexdigest())
 
     unpack(dn, cachefile)
     app.config['counter'].increment()
 
-    if app.config.get('kbas-password', 'insecure') != 'insecure' and \
-            app.config.get('kbas-url') is not None:
-        if dn.get('kind', 'chunk') in app.config.get('kbas-upload', 'chunk'):
-            with app.timer(dn, 'upload'):
-                upload(dn)
-
 
 def update_manifest(dn, manifest):
     with open(manifest, "a") as m:
@@ -180,7 +461,7 @@ def update_manifest(dn, manifest):
                               get_repo_url(dn.get('repo', 'None')),
                               dn.get('ref', 'None'),
                               dn.get('unpetrify-ref', 'None'),
-                              md5(get_cache(dn))))
+                              checksum(get_cache(dn))))
             m.flush()
             return
 
@@ -189,32 +470,39 @@ def update_manifest(dn, manifest):
                             'repo': get_repo_url(dn.get('repo', None)),
                             'sha': dn.get('sha', None),
                             'ref': dn.get('unpetrify-ref', None),
-                            'md5': md5(get_cache(dn))}}
+                            algorithm(): checksum(get_cache(dn))}}
         m.write(yaml.dump(text, default_flow_style=True))
         m.flush()
 
 
 def unpack(dn, tmpfile):
     if dn.get('kind') != 'system':
-        unpackdir = tmpfile + '.unpacked'
-        os.makedirs(unpackdir)
-        if call(['tar', 'xf', tmpfile, '--directory', unpackdir]):
-            app.log(dn, 'Problem unpacking', tmpfile, exit=True)
-    else:
-        with open(os.devnull, "w") as fnull:
-            if call(['tar', 'tvf', tmpfile], stdout=fnull, stderr=fnull):
+        # downloaded artifacts are only extracted when a sandbox needs them
+        if not os.path.exists(tmpfile + '.members'):
+            members = utils.tar_members(tmpfile)
+            if members is None:
                 app.log(dn, 'Problem with tarfile', tmpfile, exit=True)
+            utils.write_members(tmpfile, members)
+    else:
+        if utils.untar(tmpfile, os.path.dirname(tmpfile), ['t']):
+            app.log(dn, 'Problem with tarfile', tmpfile, exit=True)
 
     try:
         path = os.path.join(app.config['artifacts'], cache_key(dn))
         shutil.move(os.path.dirname(tmpfile), path)
         if not os.path.isdir(path):
             app.log(dn, 'Problem creating artifact', path, exit=True)
+        index()[cache_key(dn)] = True
+        artifact = os.path.join(path, cache_key(dn))
+        if app.config.get('deduplicate-artifacts') and \
+                os.path.isdir(artifact + '.unpacked'):
+            cas.dedup(artifact, artifact + '.unpacked')
+        usage.record(dn, path)
 
         size = os.path.getsize(get_cache(dn))
         size = re.sub("(\d)(?=(\d{3})+(?!\d))", r"\1,", "%d" % size)
-        checksum = md5(get_cache(dn))
-        app.log(dn, 'Cached %s bytes %s as' % (size, checksum), cache_key(dn))
+        digest = checksum(get_cache(dn))
+        app.log(dn, 'Cached %s bytes %s as' % (size, digest), cache_key(dn))
         return path
     except:
         app.log(dn, 'Bah! I raced on', cache_key(dn))
@@ -223,11 +511,24 @@ def unpack(dn, tmpfile):
 
 
 def upload(dn):
+    ''' Send the artifact for dn to kbas, if we are configured to do so. '''
+
+    if app.config.get('kbas-password', 'insecure') == 'insecure' or \
+            app.config.get('kbas-url') is None:
+        return
+    if dn.get('kind', 'chunk') not in app.config.get('kbas-upload', 'chunk'):
+        return
+    with app.timer(dn, 'upload'), history.timer(dn, 'upload'):
+        send(dn)
+
+
+def send(dn):
     cachefile = get_cache(dn)
     url = app.config['kbas-url'] + 'upload'
+    digest = checksum(cachefile)
     params = {"filename": dn['cache'],
               "password": app.config['kbas-password'],
-              "checksum": md5(cachefile)}
+              "checksum": digest}
     with open(cachefile, 'rb') as f:
         try:
             response = requests.post(url=url, data=params, files={"file": f})
@@ -235,11 +536,11 @@ def upload(dn):
                 app.log(dn, 'Uploaded %s to kbas' % dn['cache'])
                 return
             if response.status_code == 777:
-                app.log(dn, 'Reproduced %s at' % md5(cachefile), dn['cache'])
-                app.config['reproduced'].append([md5(cachefile), dn['cache']])
+                app.log(dn, 'Reproduced %s at' % digest, dn['cache'])
+                app.config['reproduced'].append([digest, dn['cache']])
                 return
             if response.status_code == 405:
-                # server has different md5 for this artifact
+                # server has a different checksum for this artifact
                 if dn['kind'] == 'stratum' and app.config['reproduce']:
                     app.log('BIT-FOR-BIT',
                             'WARNING: reproduction failed for', dn['cache'])
@@ -251,6 +552,24 @@ def upload(dn):
         app.log(dn, 'Failed to upload', dn['cache'])
 
 
+_index = None
+
+
+def index():
+    '''Return what we know about the artifacts directory.
+
+    This maps the cache-key of each artifact found to True once we have
+    checked it is ready for use (and touched it for cull), or False if we
+    have not. Missing keys may have been added by other instances
+    since, so callers must check the filesystem for those.
+
+    '''
+    global _index
+    if _index is None:
+        _index = {key: False for key in os.listdir(app.config['artifacts'])}
+    return _index
+
+
 def get_cache(dn):
     ''' Check if a cached artifact exists for the hashed version of d. '''
 
@@ -258,31 +577,123 @@ def get_cache(dn):
         return False
 
     cachedir = os.path.join(app.config['artifacts'], cache_key(dn))
+    artifact = os.path.join(cachedir, cache_key(dn))
+    if index().get(cache_key(dn)):
+        return artifact
+
     if os.path.isdir(cachedir):
-        call(['touch', cachedir])
-        artifact = os.path.join(cachedir, cache_key(dn))
-        unpackdir = artifact + '.unpacked'
-        if not os.path.isdir(unpackdir) and dn.get('kind') != 'system':
-            tempfile.tempdir = app.config['tmp']
-            tmpdir = tempfile.mkdtemp()
-            if call(['tar', 'xf', artifact, '--directory', tmpdir]):
-                app.log(dn, 'Problem unpacking', artifact)
-                return False
-            try:
-                shutil.move(tmpdir, unpackdir)
-            except:
-                # corner case... if we are here ybd is multi-instance, this
-                # artifact was uploaded from somewhere, and more than one
-                # instance is attempting to unpack. another got there first
-                pass
+        # touch once per run, so cull can find the least recently used
+        usage.touch(cache_key(dn))
+        index()[cache_key(dn)] = True
         return artifact
 
     return False
 
 
+def get_unpacked(dn):
+    ''' Return the path of the extracted artifact for dn, extracting it now
+    if nothing has needed it before. '''
+
+    artifact = get_cache(dn)
+    if not artifact:
+        return False
+
+    unpackdir = artifact + '.unpacked'
+    if not os.path.isdir(unpackdir):
+        tempfile.tempdir = app.config['tmp']
+        tmpdir = tempfile.mkdtemp()
+        if utils.untar(artifact, tmpdir):
+            app.log(dn, 'Problem unpacking', artifact)
+            return False
+        try:
+            shutil.move(tmpdir, unpackdir)
+            if app.config.get('deduplicate-artifacts'):
+                cas.dedup(artifact, unpackdir)
+            usage.unpacked(cache_key(dn), unpackdir)
+        except:
+            # corner case... if we are here ybd is multi-instance, this
+            # artifact was uploaded from somewhere, and more than one
+            # instance is attempting to unpack. another got there first
+            pass
+    return unpackdir
+
+
+def get_member(dn, name):
+    '''Return the contents of file name in the artifact for dn, or None.'''
+
+    return get_members(dn, [name])[0]
+
+
+def get_members(dn, names):
+    '''Return the contents of each of names in the artifact for dn.
+
+    The contents are None for any file which isn't in the artifact. If the
+    artifact hasn't been extracted, we find the files in the archive from
+    the offsets in <artifact>.members, rather than extract it all, and read
+    them all in one pass through the archive.
+
+    '''
+    artifact = get_cache(dn)
+    if not artifact:
+        return [None] * len(names)
+
+    if os.path.isdir(artifact + '.unpacked'):
+        contents = []
+        for name in names:
+            try:
+                with open(os.path.join(artifact + '.unpacked', name)) as f:
+                    contents += [f.read()]
+            except IOError:
+                contents += [None]
+        return contents
+
+    try:
+        with open(artifact + '.members') as f:
+            members = json.load(f)
+    except (IOError, ValueError):
+        # an artifact from before we kept an index
+        if not get_unpacked(dn):
+            return [None] * len(names)
+        return get_members(dn, names)
+
+    found = [os.path.normpath(name) for name in names
+             if os.path.normpath(name) in members]
+    data = dict(zip(found, utils.read_members(
+        artifact, [members[name] for name in found])))
+    return [data.get(os.path.normpath(name)) for name in names]
+
+
+def get_file_types(dn):
+    '''Return the type of every path in the artifact for dn, or None.
+
+    This is kept alongside the artifact as <artifact>.types, so we only have
+    to walk the unpacked artifact once.
+
+    '''
+    artifact = get_cache(dn)
+    if not artifact:
+        return None
+
+    try:
+        with open(artifact + '.types') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        pass
+
+    if not get_unpacked(dn):
+        return None
+    types = utils.file_types(artifact + '.unpacked')
+    try:
+        with open(artifact + '.types', 'w') as f:
+            json.dump(types, f, sort_keys=True)
+    except IOError:
+        pass  # we can manage without it
+    return types
+
+
 def get_remote(dn):
     ''' If a remote cached artifact exists for d, retrieve it '''
-    if app.config.get('last-retry-component') == dn or dn.get('tried'):
+    if dn.get('tried'):
         return False
 
     dn['tried'] = True  # let's not keep asking for this artifact
@@ -291,93 +702,290 @@ def get_remote(dn):
         return False
 
     try:
-        app.log(dn, 'Try downloading', cache_key(dn))
-        url = app.config['kbas-url'] + 'get/' + cache_key(dn)
-        response = requests.get(url=url, stream=True)
+        cachefile = fetch(dn)
     except:
-        app.config.pop('kbas-url')
+        app.config.pop('kbas-url', None)
         app.log(dn, 'WARNING: remote artifact server is not working')
         return False
 
-    if response.status_code == 200:
-        try:
-            tempfile.tempdir = app.config['tmp']
-            tmpdir = tempfile.mkdtemp()
-            cachefile = os.path.join(tmpdir, cache_key(dn))
-            with open(cachefile, 'wb') as f:
-                f.write(response.content)
+    if cachefile:
+        return unpack(dn, cachefile)
+    return False
 
-            return unpack(dn, cachefile)
 
-        except:
-            app.log(dn, 'WARNING: failed downloading', cache_key(dn))
+def fetch(dn):
+    '''Download the artifact for dn from kbas, and return the file, or None.
 
-    return False
+    This only writes to a new directory in tmp, so prefetch() can run it in
+    threads. It raises an exception if kbas can't be reached.
 
+    '''
+    app.log(dn, 'Try downloading', cache_key(dn))
+    url = app.config['kbas-url'] + 'get/' + cache_key(dn)
+    response = requests.get(url=url, stream=True)
+    if response.status_code != 200:
+        return None
 
-def cull(artifact_dir):
-    tempfile.tempdir = app.config['tmp']
-    deleted = 0
+    tmpdir = tempfile.mkdtemp(dir=app.config['tmp'])
+    cachefile = os.path.join(tmpdir, cache_key(dn))
+    try:
+        if download(dn, url, response, cachefile):
+            return cachefile
+    except:
+        app.log(dn, 'WARNING: failed downloading', cache_key(dn))
+    shutil.rmtree(tmpdir)
+    return None
 
-    def clear(deleted, artifact_dir):
-        artifacts = utils.sorted_ls(artifact_dir)
-        for artifact in artifacts:
-            stat = os.statvfs(artifact_dir)
-            free = stat.f_frsize * stat.f_bavail / 1000000000
-            if free >= app.config.get('min-gigabytes', 10):
-                app.log('SETUP', '%sGB is enough free space' % free)
-                if deleted > 0:
-                    app.log('SETUP', 'Culled %s items in' % deleted,
-                            artifact_dir)
-                return True
-            path = os.path.join(artifact_dir, artifact)
-            if os.path.exists(os.path.join(path, artifact + '.unpacked')):
-                path = os.path.join(path, artifact + '.unpacked')
-            if os.path.exists(path) and artifact not in app.config['keys']:
-                tmpdir = tempfile.mkdtemp()
-                shutil.move(path, os.path.join(tmpdir, 'to-delete'))
-                app.remove_dir(tmpdir)
-                deleted += 1
+
+def download(dn, url, response, cachefile, retries=3):
+    '''Stream an artifact to cachefile, resuming if the connection drops.
+
+    The checksum is computed as the bytes arrive, and checked against the
+    one kbas sends in the X-Checksum-<algorithm> header, if any.
+
+    '''
+    digest = new_checksum()
+    expected = response.headers.get('X-Checksum-%s' % algorithm())
+    with open(cachefile, 'wb') as f:
+        while True:
+            try:
+                for chunk in response.iter_content(chunk_size=1024 * 1024):
+                    f.write(chunk)
+                    digest.update(chunk)
+                break
+            except (requests.exceptions.RequestException, IOError) as e:
+                if retries == 0:
+                    raise
+                retries -= 1
+                app.log(dn, 'WARNING: resuming download after %s bytes:' %
+                        f.tell(), e)
+                headers = {'Range': 'bytes=%s-' % f.tell()}
+                response = requests.get(url=url, stream=True, headers=headers)
+                if response.status_code == 200:
+                    # server ignored the range, so start again
+                    f.seek(0)
+                    f.truncate()
+                    digest = new_checksum()
+                elif response.status_code != 206:
+                    raise
+
+    if expected and digest.hexdigest() != expected:
+        app.log(dn, 'WARNING: checksum mismatch downloading', cache_key(dn))
         return False
+    write_checksum(cachefile, digest.hexdigest())
+    return True
+
 
-    # cull unpacked dirs first
-    if clear(deleted, artifact_dir):
+def prefetch(dns):
+    '''Download every artifact in dns which kbas has and we don't.
+
+    Once all the cache keys are known we can ask kbas which of the missing
+    artifacts it has, and download them in parallel, rather than waiting
+    for each one as compose() gets to it.
+
+    '''
+    if not app.config.get('kbas-url') or app.config.get('reproduce'):
+        return
+    kinds = app.config.get('kbas-upload', 'chunk')
+    missing = {}
+    for dn in dns:
+        if dn.get('cache') and dn.get('kind', 'chunk') in kinds:
+            if not get_cache(dn):
+                missing[dn['cache']] = dn
+    if missing == {}:
         return
 
-    # cull artifacts
-    if clear(deleted, artifact_dir):
+    try:
+        url = app.config['kbas-url'] + 'query'
+        response = requests.post(url=url,
+                                 data={'keys': ' '.join(sorted(missing))})
+        available = response.json()['available']
+    except:
+        app.log('PREFETCH', 'WARNING: kbas does not support query at', url)
         return
 
-    stat = os.statvfs(artifact_dir)
-    free = stat.f_frsize * stat.f_bavail / 1000000000
+    # only the downloads run in threads. Unpacking updates the index and
+    # usage, so we do that here as each download finishes
+    def get(key):
+        try:
+            return missing[key], fetch(missing[key])
+        except Exception:
+            return missing[key], False
+
+    message = 'download of %s/%s missing artifacts' % (
+        len(available), len(missing))
+    with app.timer('PREFETCH', message):
+        pool = ThreadPool(int(app.config.get('prefetch-threads', 8)))
+        working = True
+        for dn, cachefile in pool.imap_unordered(get, available):
+            dn['tried'] = True
+            if cachefile is False:
+                working = False
+            elif cachefile and unpack(dn, cachefile):
+                app.config['counter'].increment()
+        pool.close()
+        pool.join()
+    if not working:
+        app.config.pop('kbas-url', None)
+        app.log('PREFETCH', 'WARNING: remote artifact server is not working')
+
+
+def cull(artifact_dir, exit=True, margin=0):
+    '''Remove least recently used artifacts until we are within limits.
+
+    We need min-gigabytes free, and if max-gigabytes (or max-gigabytes for
+    a kind of artifact) is set, the cache can't be bigger than that. We cull
+    .unpacked dirs first, since they can be recreated from the artifacts,
+    and never cull the artifacts needed for any run which is still going.
+    If anything is culled, sandbox snapshots in tmp are removed too.
+
+    If margin is given, we cull until there are that many gigabytes more
+    than min-gigabytes free. If there still isn't min-gigabytes free we
+    exit, or return False if exit is False.
+
+    '''
+    deleted = 0
+    keys = protected()
+
+    if app.config.get('check-blobs'):
+        # the unpacked artifacts using damaged blobs can be extracted again
+        damaged = cas.damaged()
+        culled = cas.users(damaged, artifact_dir)
+        for key in culled:
+            app.log('SETUP', 'WARNING: files have been changed in', key)
+            app.trash(os.path.join(artifact_dir, key, key + '.unpacked'))
+            index()[key] = False
+        usage.execute('UPDATE usage SET unpacked = 0 WHERE cache = ?',
+                      *[(key,) for key in culled])
+        for key in damaged:
+            os.remove(os.path.join(cas.blobs_dir(), key[:2], key))
+        blobs = cas.collect()
+        app.log('SETUP', 'Removed %s unused blobs from' % blobs, artifact_dir)
+
+    db = usage.sync(artifact_dir)
+    GB = 1000000000
+    free = app.free_space(artifact_dir)
+    minimum = app.config.get('min-gigabytes', 10)
+    need = (minimum + margin if minimum else 0) * GB - free
+    totals = dict(db.execute('SELECT kind, SUM(size + unpacked) FROM usage '
+                             'GROUP BY kind').fetchall())
+    if app.config.get('max-gigabytes'):
+        need = max(need, sum(totals.values()) -
+                   app.config['max-gigabytes'] * GB)
+    excess = {kind: totals.get(kind, 0) - limit * GB for kind, limit in
+              app.config.get('max-gigabytes-by-kind', {}).items()}
+
+    def remove(key, path, size):
+        blobs = cas.manifest(os.path.join(artifact_dir, key, key))
+        app.trash(path, size)
+        cas.forget(blobs)
+
+    # cull unpacked dirs first, then whole artifacts
+    for unpacked in [True, False]:
+        if need <= 0 and all(e <= 0 for e in excess.values()):
+            break
+        query = 'SELECT cache, kind, size, unpacked FROM usage '
+        if unpacked:
+            query += 'WHERE unpacked > 0 '
+        culled = []
+        for key, kind, size, unpacked_size in db.execute(query +
+                                                         'ORDER BY used'):
+            if need <= 0 and all(e <= 0 for e in excess.values()):
+                break
+            if key in keys:
+                continue
+            if need <= 0 and excess.get(kind, 0) <= 0:
+                continue
+            path = os.path.join(artifact_dir, key)
+            if unpacked:
+                path = os.path.join(path, key + '.unpacked')
+                freed = unpacked_size
+            else:
+                freed = size + unpacked_size
+            if os.path.exists(path):
+                remove(key, path, freed)
+                deleted += 1
+            # this is deleted in the background, but we can count it now
+            need -= freed
+            free += freed
+            if kind in excess:
+                excess[kind] -= freed
+            culled.append((key,))
+            if unpacked:
+                index()[key] = False
+            else:
+                index().pop(key, None)
+
+        with db:
+            if unpacked:
+                db.executemany('UPDATE usage SET unpacked = 0 '
+                               'WHERE cache = ?', culled)
+            else:
+                db.executemany('DELETE FROM usage WHERE cache = ?', culled)
+    db.close()
+
+    if deleted > 0:
+        app.log('SETUP', 'Culled %s items in' % deleted, artifact_dir)
+        # snapshots are hardlinked to staged artifacts, so they would keep
+        # culled files on disk. They are made again as builds need them.
+        app.remove_dir(os.path.join(app.config['tmp'], 'snapshots'))
+
+    free = free / GB
     if free < app.config.get('min-gigabytes', 10):
         app.log('SETUP', '%sGB is less than min-gigabytes:' % free,
-                app.config.get('min-gigabytes', 10), exit=True)
+                app.config.get('min-gigabytes', 10), exit=exit)
+        return False
+    app.log('SETUP', '%sGB is enough free space' % free)
+    return True
 
 
 def check(artifact):
     try:
         artifact = os.path.join(app.config['artifact-dir'], artifact,
                                 artifact)
-        checkfile = artifact + '.md5'
-        if not os.path.exists(checkfile):
-            checksum = md5(artifact)
-            with open(checkfile, "w") as f:
-                f.write(checksum)
-
-        return(open(checkfile).read())
+        return checksum(artifact)
     except:
         return('================================')
 
 
-def md5(filename):
-    # From http://stackoverflow.com/questions/3431825
-    # answer by http://stackoverflow.com/users/370483/quantumsoup
-    hash = hashlib.md5()
+def algorithm():
+    return app.config.get('checksum-algorithm', 'md5')
+
+
+def new_checksum():
     try:
-        with open(filename, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash.update(chunk)
-        return hash.hexdigest()
-    except:
-        return None
+        return hashlib.new(algorithm())
+    except ValueError:
+        app.log('CHECKSUM', 'ERROR: unknown checksum-algorithm', algorithm(),
+                exit=True)
+
+
+def checksum(filename):
+    '''Return the checksum of filename, using checksum-algorithm.
+
+    The result is kept in a sidecar file (eg <artifact>.md5), which is
+    normally written as the artifact is created or downloaded, so we only
+    read big artifacts once.
+
+    '''
+    sidecar = '%s.%s' % (filename, algorithm())
+    try:
+        with open(sidecar) as f:
+            return f.read().strip()
+    except IOError:
+        pass
+
+    digest = new_checksum()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    write_checksum(filename, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def write_checksum(filename, digest):
+    try:
+        with open('%s.%s' % (filename, algorithm()), 'w') as f:
+            f.write(digest)
+    except IOError:
+        pass  # we can manage without it
@@ -0,0 +1,208 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Store each unique file in unpacked artifacts only once.
+
+With deduplicate-artifacts set, every regular file in an unpacked artifact
+is a hardlink to a blob in artifacts/.blobs, named by the hash of its
+contents and metadata. Each artifact records its blobs in <key>.blobs,
+so when cull() removes an artifact we can remove any blobs that nothing
+else links to, once the reaper has deleted the artifact from trash.
+
+'''
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import stat
+
+import app
+
+
+def blobs_dir():
+    return os.path.join(app.config['artifacts'], '.blobs')
+
+
+def blob_hash(path, st):
+    # hardlinks share metadata as well as contents, so both must match
+    checksum = hashlib.sha256('%o %s %s %s\0' % (st.st_mode, st.st_uid,
+                                                 st.st_gid, int(st.st_mtime)))
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def link(path, blob):
+    '''Make path a hardlink to blob, or make blob from path if it's new.'''
+
+    if not os.path.isdir(os.path.dirname(blob)):
+        try:
+            os.makedirs(os.path.dirname(blob))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    while True:
+        try:
+            os.link(path, blob)
+            return
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # path is ours, so a name from our pid next to it is ours too
+        tmpfile = os.path.join(os.path.dirname(path), '.%s.%s' % (
+            os.getpid(), os.path.basename(blob)))
+        try:
+            os.link(blob, tmpfile)
+            os.rename(tmpfile, path)
+            return
+        except OSError as e:
+            # blob was released by cull() in the meantime
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def dedup(artifact, unpackdir):
+    '''Replace the files in unpackdir by links to blobs, and record them.'''
+
+    blobs = []
+    for dirname, subdirs, files in os.walk(unpackdir):
+        for name in files:
+            path = os.path.join(dirname, name)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            key = blob_hash(path, st)
+            blob = os.path.join(blobs_dir(), key[:2], key)
+            link(path, blob)
+            blobs.append(key)
+
+    with open(artifact + '.blobs', 'w') as f:
+        json.dump(sorted(set(blobs)), f)
+
+
+def manifest(artifact):
+    '''Return the blobs used by artifact, if any.'''
+
+    try:
+        with open(artifact + '.blobs') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+
+def release(blobs):
+    '''Remove any of blobs which are no longer linked from an artifact.'''
+
+    for key in blobs:
+        blob = os.path.join(blobs_dir(), key[:2], key)
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except OSError:
+            pass
+
+
+def released():
+    return os.path.join(blobs_dir(), '.released')
+
+
+def forget(blobs):
+    '''Release blobs when the reaper has deleted the artifact using them.
+
+    A culled artifact still links to its blobs while it is in trash, so we
+    note the blobs here for reclaim(), rather than releasing them now.
+
+    '''
+    if blobs == []:
+        return
+    with open(released(), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(''.join(key + '\n' for key in blobs))
+
+
+@contextlib.contextmanager
+def reclaim():
+    '''Release the blobs forgotten so far, once the trash has been emptied.
+
+    We take the list before the trash is emptied, so every artifact which
+    forgot them has already been handed over to trash.
+
+    '''
+    blobs = []
+    try:
+        with open(released(), 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            blobs = f.read().split()
+            f.truncate(0)
+    except IOError:
+        pass
+    try:
+        yield
+    finally:
+        release(blobs)
+
+
+def damaged():
+    '''Return the blobs whose files no longer match their names.
+
+    Blobs are shared by every artifact which has the same file, so a build
+    which changes a staged file in place, rather than replacing it, changes
+    that file in all of those artifacts.
+
+    '''
+    blobs = set()
+    for dirname, subdirs, files in os.walk(blobs_dir()):
+        for name in files:
+            blob = os.path.join(dirname, name)
+            if not name.startswith('.') and \
+                    blob_hash(blob, os.stat(blob)) != name:
+                blobs.add(name)
+    return blobs
+
+
+def users(blobs, artifact_dir):
+    '''Return the keys of the artifacts which use any of blobs.'''
+
+    keys = []
+    for key in os.listdir(artifact_dir):
+        if blobs & set(manifest(os.path.join(artifact_dir, key, key))):
+            keys.append(key)
+    return keys
+
+
+def collect():
+    '''Remove all blobs which are no longer linked from an artifact.
+
+    This checks every blob, so it is only used with check-blobs, to clean
+    up after anything which went wrong in forget() and reclaim(), or after
+    cull() has removed damaged() blobs.
+
+    '''
+
+    count = 0
+    if not os.path.isdir(blobs_dir()):
+        return count
+    for dirname, subdirs, files in os.walk(blobs_dir()):
+        for name in files:
+            blob = os.path.join(dirname, name)
+            if not name.startswith('.') and os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+                count += 1
+    return count
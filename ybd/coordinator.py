@@ -0,0 +1,226 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Share the builds for one target between workers on many machines.
+
+A coordinator holds the dependency graph for the target and hands out ready
+components to workers over XML-RPC. Workers compose the component they are
+given, and artifacts are exchanged via kbas: workers upload everything they
+build, and download dependencies from kbas as they need them.
+
+'''
+
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+import os
+import socket
+import threading
+import time
+import xmlrpclib
+
+import app
+from app import config, log
+from assembly import compose
+from cache import cache_key, get_cache, get_remote, rekey
+import scheduler
+
+
+class Coordinator(object):
+
+    def __init__(self, target):
+        self.target = target
+        self.nodes, self.order = scheduler.graph(target)
+        self.estimate = scheduler.estimator()
+        self.rank = scheduler.priorities(self.nodes, self.order,
+                                         self.estimate)
+        self.done = set()
+        self.assigned = {}
+        self.workers = {}
+        self.seen = {}
+        self.lost = {}
+        self.failed = None
+        self.lock = threading.RLock()
+
+    def finished(self):
+        return self.failed or self.target['path'] in self.done
+
+    def heartbeat(self, worker):
+        with self.lock:
+            self.seen[worker] = time.time()
+        return True
+
+    def requeue(self, worker):
+        '''Take back jobs from worker if it has given up on them or died.
+
+        A worker asking for a new job has abandoned its old one, and a worker
+        we haven't heard from for a while has probably exited. We give each
+        job a second chance with another worker before giving up on it.
+
+        '''
+        timeout = int(config.get('timeout', 60))
+        for path, owner in self.assigned.items():
+            if owner == worker or time.time() - self.seen[owner] > timeout:
+                log('COORDINATOR', 'WARNING: %s abandoned' % owner, path)
+                del self.assigned[path]
+                self.workers[owner] = 'stopped'
+                self.lost[path] = self.lost.get(path, 0) + 1
+                if self.lost[path] > 1:
+                    self.failed = path
+
+    def job(self, worker):
+        '''Return the next job for worker, or tell it to wait or stop.'''
+
+        with self.lock:
+            self.requeue(worker)
+            self.heartbeat(worker)
+
+            if self.failed:
+                self.workers[worker] = 'stopped'
+                return {'failed': self.failed}
+            if self.finished():
+                self.workers[worker] = 'stopped'
+                return {'done': True}
+            self.workers[worker] = 'waiting'
+
+            candidates = [dn for dn in scheduler.ready(self.nodes, self.order,
+                                                       self.done, set())
+                          if dn['path'] not in self.assigned]
+            if candidates == []:
+                return {'wait': True}
+
+            dn = max(candidates, key=lambda dn: self.rank[dn['path']])
+            self.assigned[dn['path']] = worker
+            self.workers[worker] = dn['path']
+            log('COORDINATOR', 'Sending %s to' % dn['cache'], worker)
+            return {'path': dn['path'], 'cache': dn['cache']}
+
+    def complete(self, worker, path):
+        with self.lock:
+            self.heartbeat(worker)
+            self.assigned.pop(path, None)
+            self.workers[worker] = 'waiting'
+            self.done.add(path)
+            log('COORDINATOR', '%s completed' % worker, path)
+            scheduler.eta(self.order, self.done, self.rank, self.estimate)
+        return True
+
+    def fail(self, worker, path):
+        with self.lock:
+            self.assigned.pop(path, None)
+            self.workers[worker] = 'stopped'
+            self.failed = path
+            log('COORDINATOR', 'ERROR: %s failed to build' % worker, path)
+        return True
+
+
+def coordinate(target):
+    '''Serve jobs for target until it has been built, or something fails.'''
+
+    coordinator = Coordinator(target)
+    server = SimpleXMLRPCServer(('0.0.0.0', int(config['coordinator-port'])),
+                                logRequests=False, allow_none=True)
+    server.register_function(coordinator.job, 'job')
+    server.register_function(coordinator.complete, 'complete')
+    server.register_function(coordinator.fail, 'fail')
+    server.register_function(coordinator.heartbeat, 'heartbeat')
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    log('COORDINATOR', 'Serving jobs for %s on port' % target['name'],
+        config['coordinator-port'])
+    with coordinator.lock:
+        scheduler.ready(coordinator.nodes, coordinator.order,
+                        coordinator.done, set())
+        scheduler.eta(coordinator.order, coordinator.done, coordinator.rank,
+                      coordinator.estimate)
+
+    while not coordinator.finished():
+        time.sleep(1)
+        with coordinator.lock:
+            coordinator.requeue(None)
+
+    # give the workers a chance to hear that we're finished
+    deadline = time.time() + int(config.get('timeout', 60))
+    while time.time() < deadline and any(
+            state != 'stopped' for state in coordinator.workers.values()):
+        time.sleep(1)
+    server.shutdown()
+
+    if coordinator.failed:
+        log(target, 'Build failed for', coordinator.failed, exit=True)
+    if not get_cache(target) and not get_remote(target):
+        log(target, 'WARNING: unable to download', target['cache'])
+
+
+def work(target):
+    '''Ask the coordinator for jobs, and compose them until we're told.'''
+
+    worker = '%s:%s' % (socket.gethostname(), os.getpid())
+    coordinator = xmlrpclib.ServerProxy(config['coordinator-url'],
+                                        allow_none=True)
+    log('WORKER', 'I am worker', worker)
+    if config.get('kbas-password', 'insecure') == 'insecure':
+        log('WORKER', 'WARNING: kbas-password is not set, so other workers '
+            'will not see our artifacts')
+
+    def heartbeat():
+        coordinator = xmlrpclib.ServerProxy(config['coordinator-url'])
+        while True:
+            try:
+                coordinator.heartbeat(worker)
+            except socket.error:
+                pass
+            time.sleep(10)
+
+    thread = threading.Thread(target=heartbeat)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        try:
+            job = coordinator.job(worker)
+        except socket.error as e:
+            log('WORKER', 'ERROR: no coordinator at %s:' %
+                config['coordinator-url'], e, exit=True)
+
+        if job.get('done'):
+            log('WORKER', 'Coordinator says we are done')
+            return
+        if job.get('failed'):
+            log('WORKER', 'Coordinator says build failed for', job['failed'],
+                exit=True)
+        if job.get('wait'):
+            time.sleep(1)
+            continue
+
+        # with early-cutoff, only the workers know what was produced
+        dn = app.defs.get(job['path'])
+        rekey(dn)
+        if cache_key(dn) != job['cache'] and not config.get('early-cutoff'):
+            coordinator.fail(worker, job['path'])
+            log(dn, 'ERROR: coordinator expects', job['cache'], exit=True)
+
+        # compose() raises BuildError in keep-going mode, otherwise a failed
+        # build exits, and the coordinator finds out from the heartbeats
+        try:
+            compose(dn)
+        except app.BuildError:
+            coordinator.fail(worker, job['path'])
+            raise
+
+        if not get_cache(dn):
+            coordinator.fail(worker, job['path'])
+            log(dn, 'No artifact after composing', cache_key(dn), exit=True)
+        coordinator.complete(worker, job['path'])
@@ -15,11 +15,11 @@
 # =*= License: GPL-2 =*=
 
 import os
-from subprocess import call
 import json
 import app
 import cache
 import sandbox
+import utils
 
 
 def deploy(target):
@@ -49,9 +49,7 @@ def deploy_system(system_spec, parent_location=''):
 
     with sandbox.setup(system):
         app.log(system, 'Extracting system artifact into', system['sandbox'])
-        with open(cache.get_cache(system), 'r') as artifact:
-            call(['tar', 'x', '--directory', system['sandbox']],
-                 stdin=artifact)
+        utils.untar(cache.get_cache(system), system['sandbox'])
 
         for subsystem in system_spec.get('subsystems', []):
             if deploy_defaults:
@@ -0,0 +1,111 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Record how long things take, so we can plan ahead next time.
+
+History is kept in a small sqlite database in the artifacts directory,
+with one row per measurement, keyed by component name and cache key.
+
+'''
+
+from contextlib import contextmanager
+import os
+import sqlite3
+import time
+
+import app
+
+
+def connect():
+    db = sqlite3.connect(os.path.join(app.config['artifacts'], '.history'),
+                         timeout=int(app.config.get('timeout', 60)))
+    db.execute('CREATE TABLE IF NOT EXISTS history '
+               '(name TEXT, cache TEXT, phase TEXT, value REAL, time REAL)')
+    return db
+
+
+def record(dn, phase, value):
+    ''' Save a measurement (usually in seconds) for phase of dn. '''
+
+    try:
+        db = connect()
+        with db:
+            db.execute('INSERT INTO history VALUES (?, ?, ?, ?, ?)',
+                       (dn['name'], dn['cache'], phase, value, time.time()))
+        db.close()
+    except sqlite3.Error as e:
+        app.log(dn, 'WARNING: unable to record %s history:' % phase, e)
+
+
+@contextmanager
+def timer(dn, phase):
+    ''' Record how long the body of the with statement takes for dn. '''
+
+    starttime = time.time()
+    yield
+    record(dn, phase, time.time() - starttime)
+
+
+def load(phase):
+    '''Return previous measurements for phase.
+
+    The result is a pair of dicts: the latest value for each cache key,
+    and the mean of the values for each name.
+
+    '''
+
+    by_key, by_name = {}, {}
+    try:
+        db = connect()
+        rows = db.execute('SELECT cache, value FROM history WHERE phase = ? '
+                          'ORDER BY time', (phase,)).fetchall()
+        for key, value in rows:
+            by_key[key] = value
+        rows = db.execute('SELECT name, AVG(value) FROM history '
+                          'WHERE phase = ? GROUP BY name', (phase,))
+        by_name = dict(rows.fetchall())
+        db.close()
+    except sqlite3.Error as e:
+        app.log('HISTORY', 'WARNING: unable to load %s history:' % phase, e)
+    return by_key, by_name
+
+
+def estimator(*phases):
+    '''Return a function which estimates the total of phases for a component.
+
+    For each phase we prefer a measurement for the exact cache key, then the
+    average for the component name, and finally the average over everything
+    we know. Phases we have never measured count as zero.
+
+    '''
+
+    history = []
+    for phase in phases:
+        by_key, by_name = load(phase)
+        values = by_name.values()
+        default = sum(values) / len(values) if values else 0
+        history.append((by_key, by_name, default))
+
+    def estimate(dn):
+        total = 0
+        for by_key, by_name, default in history:
+            if dn.get('cache') in by_key:
+                total += by_key[dn['cache']]
+            else:
+                total += by_name.get(dn['name'], default)
+        return total
+
+    return estimate
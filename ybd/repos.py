@@ -20,7 +20,7 @@ import re
 import errno
 import shutil
 import string
-from subprocess import call, check_output
+from subprocess import call, check_output, PIPE, Popen
 import sys
 import requests
 import app
@@ -88,16 +88,63 @@ def get_last_tag(gitdir):
         return None
 
 
-def get_tree(dn):
+def get_ref(dn):
     ref = str(dn.get('ref', str(dn.get('sha'))))
     track = app.config.get('track-branches')
     if dn.get('unpetrify-ref') and track:
         if track is True or dn['path'] in track:
             ref = str(dn['unpetrify-ref'])
+    return ref
+
+
+def get_gitdir(repo):
+    if repo.startswith('file://') or repo.startswith('/'):
+        return repo.replace('file://', '')
+    return os.path.join(app.config['gits'], get_repo_name(repo))
+
+
+def resolve_trees(dns):
+    '''Find tree and sha for many definitions at once, returning the count.
+
+    Refs are grouped by repo, and each repo is asked for all of its refs by
+    a single `git cat-file --batch-check`, with repos queried in parallel.
+    Anything we can't resolve from the local mirrors is left for get_tree()
+    to deal with as usual.
 
-    gitdir = os.path.join(app.config['gits'], get_repo_name(dn['repo']))
+    '''
+    repos = {}
+    for dn in dns:
+        if dn.get('repo') and not dn.get('tree'):
+            gitdir = get_gitdir(dn['repo'])
+            if os.path.isdir(gitdir):
+                repos.setdefault(gitdir, []).append(dn)
+    if repos == {}:
+        return 0
+
+    def resolve(gitdir):
+        refs = [get_ref(dn) for dn in repos[gitdir]]
+        query = ''.join('%s\n%s^{tree}\n' % (ref, ref) for ref in refs)
+        with open(os.devnull, "w") as fnull:
+            git = Popen(['git', 'cat-file', '--batch-check'], cwd=gitdir,
+                        stdin=PIPE, stdout=PIPE, stderr=fnull)
+            output = git.communicate(query)[0].splitlines()
+        if len(output) != 2 * len(refs):
+            return 0
+        count = 0
+        for i, dn in enumerate(repos[gitdir]):
+            sha, tree = output[2 * i].split(), output[2 * i + 1].split()
+            if len(sha) == 3 and tree[1:2] == ['tree']:
+                dn['sha'], dn['tree'] = sha[0], tree[0]
+                count += 1
+        return count
+
+    return sum(utils.thread_pool().map(resolve, repos.keys()))
+
+
+def get_tree(dn):
+    ref = get_ref(dn)
+    gitdir = get_gitdir(dn['repo'])
     if dn['repo'].startswith('file://') or dn['repo'].startswith('/'):
-        gitdir = dn['repo'].replace('file://', '')
         if not os.path.isdir(gitdir):
             app.log(dn, 'Git repo not found:', dn['repo'], exit=True)
 
@@ -0,0 +1,139 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Decide how much of the machine each build gets.'''
+
+import contextlib
+import os
+import threading
+import time
+from multiprocessing import cpu_count
+
+import app
+import history
+
+
+def max_jobs(dn):
+    '''Return the number of parallel jobs to use for a build step of dn.
+
+    If the definition or the user config sets max-jobs, we just use that.
+    Otherwise we take a fair share of the cores between the instances which
+    are currently running parallel build steps, or all the cores which the
+    load average shows are idle if that is more. So a lone long compile
+    gets the whole machine, while instances in serial phases (configure,
+    install) leave their cores to the others.
+
+    Without max-jobs in the definition the cache key says nothing about
+    parallelism, but we never return 1 unless the definition asks for it,
+    so builds stay on the 'parallel' side of the max-jobs hash factor.
+
+    '''
+    if dn.get('max-jobs'):
+        return dn['max-jobs']
+
+    if app.config.get('max-jobs'):
+        return app.config['max-jobs']
+
+    cpus = cpu_count()
+    others = 0
+    if app.config.get('building'):
+        others = app.config['building'].get()
+    share = cpus / (others + 1)
+    idle = int(cpus - os.getloadavg()[0])
+    jobs = max(min(max(share, idle), cpus), 2)
+    app.log(dn, 'Max-jobs for %s other builds, load %s is' %
+            (others, os.getloadavg()[0]), jobs, verbose=True)
+    return jobs
+
+
+@contextlib.contextmanager
+def admit(dn):
+    '''Wait until there is memory to build dn, and measure what it uses.
+
+    Peak memory use from previous builds of dn is reserved from the
+    max-memory budget (in gigabytes) which all instances share. If the
+    reservation doesn't fit alongside the builds already running we wait
+    for some of them to finish, but a build is always admitted when
+    nothing else is running, however much it needs.
+
+    '''
+    if app.config.get('mode', 'normal') == 'no-build':
+        yield
+        return
+
+    need = 0
+    budget = app.config.get('max-memory')
+    if budget:
+        budget = int(budget * 1024)
+        need = int(history.estimator('memory')(dn))
+        waiting = False
+        while not app.config['memory'].reserve(need, budget):
+            if not waiting:
+                app.log(dn, 'Waiting for %sMB of memory, in use:' % need,
+                        '%sMB of %sMB' % (app.config['memory'].get(), budget))
+                waiting = True
+            time.sleep(1)
+
+    monitor = Monitor(dn['sandbox'])
+    monitor.start()
+    try:
+        yield
+    finally:
+        monitor.stop()
+        if budget:
+            app.config['memory'].release(need)
+
+    app.log(dn, 'Peak memory use was %sMB' % monitor.peak, verbose=True)
+    history.record(dn, 'memory', monitor.peak)
+
+
+class Monitor(threading.Thread):
+    '''Keep track of the peak total RSS of processes working in a sandbox.
+
+    Sandboxed commands may run in a chroot or not, but either way their
+    working directory is inside the sandbox, so that's how we find them.
+
+    '''
+
+    def __init__(self, sandbox, interval=1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sandbox = os.path.realpath(sandbox) + '/'
+        self.interval = interval
+        self.peak = 0
+        self.finished = threading.Event()
+
+    def run(self):
+        page = os.sysconf('SC_PAGE_SIZE')
+        while not self.finished.is_set():
+            total = 0
+            for pid in os.listdir('/proc'):
+                try:
+                    if not pid.isdigit():
+                        continue
+                    cwd = os.readlink(os.path.join('/proc', pid, 'cwd'))
+                    if not (cwd + '/').startswith(self.sandbox):
+                        continue
+                    with open(os.path.join('/proc', pid, 'statm')) as f:
+                        total += int(f.read().split()[1]) * page
+                except (IOError, OSError, IndexError, ValueError):
+                    pass
+            self.peak = max(self.peak, total / (1024 * 1024))
+            self.finished.wait(self.interval)
+
+    def stop(self):
+        self.finished.set()
+        self.join()
@@ -17,18 +17,20 @@
 
 import sandboxlib
 import contextlib
+import json
 import os
 import pipes
 import shutil
 import stat
 import tempfile
+import time
 from subprocess import call, PIPE
 
 import app
 import cache
+import resources
 import utils
 from repos import get_repo_url
-from fs.copy import copy_fs
 
 
 # This must be set to a sandboxlib backend before the run_sandboxed() function
@@ -41,7 +43,6 @@ def setup(dn):
     tempfile.tempdir = app.config['tmp']
     dn['sandbox'] = tempfile.mkdtemp()
     os.environ['TMPDIR'] = app.config['tmp']
-    app.config['sandboxes'] += [dn['sandbox']]
     dn['checkout'] = os.path.join(dn['sandbox'], dn['name'] + '.build')
     dn['install'] = os.path.join(dn['sandbox'], dn['name'] + '.inst')
     dn['baserockdir'] = os.path.join(dn['install'], 'baserock')
@@ -55,36 +56,207 @@ def setup(dn):
     assembly_dir = dn['sandbox']
     for directory in ['dev', 'tmp']:
         call(['mkdir', '-p', os.path.join(assembly_dir, directory)])
+    dn['layers'] = []
 
     try:
         yield
-    except app.RetryException as e:
-        raise e
+    except app.BuildError:
+        raise
     except:
         import traceback
         app.log(dn, 'ERROR: surprise exception in sandbox', '')
         traceback.print_exc()
+        # exit=True skips finally, so the layers must be unmounted here too
+        unmount(dn)
         app.log(dn, 'Sandbox debris is at', dn['sandbox'], exit=True)
     finally:
-        pass
+        unmount(dn)
 
     app.log(dn, "Removing sandbox dir", dn['sandbox'], verbose=True)
     app.remove_dir(dn['sandbox'])
 
 
+def installed(dn, component):
+    ''' Return True if component has already been installed for dn. '''
+
+    if component['name'] in [c['name'] for c, path in dn.get('layers', [])]:
+        return True
+    return os.path.exists(os.path.join(dn['sandbox'], 'baserock',
+                                       component['name'] + '.meta'))
+
+
 def install(dn, component):
     # populate dn['sandbox'] with the artifact files from component
-    if os.path.exists(os.path.join(dn['sandbox'], 'baserock',
-                                   component['name'] + '.meta')):
+    if installed(dn, component):
         return
     app.log(dn, 'Sandbox: installing %s' % component['cache'], verbose=True)
-    if cache.get_cache(component) is False:
+    unpackdir = cache.get_unpacked(component)
+    if unpackdir is False:
         app.log(dn, 'Unable to get cache for', component['name'], exit=True)
-    unpackdir = cache.get_cache(component) + '.unpacked'
-    if dn.get('kind') is 'system':
-        copy_fs(unpackdir, dn['sandbox'])
+    if use_overlayfs(dn):
+        # staged all at once by mount(), when we have all of the layers
+        dn['layers'].append((component, unpackdir))
     else:
-        utils.hardlink_all_files(unpackdir, dn['sandbox'])
+        # systems change their files, so they need copies
+        if dn.get('kind') is 'system':
+            stage = utils.copy_all_files
+        else:
+            stage = utils.hardlink_all_files
+        starttime = time.time()
+        count = stage(unpackdir, dn['sandbox'])
+        files, seconds = dn.get('staged', (0, 0))
+        dn['staged'] = (files + count, seconds + time.time() - starttime)
+
+
+def use_overlayfs(dn):
+    ''' Return True if dn's dependencies should be staged with overlayfs. '''
+
+    return (app.config.get('staging-method') == 'overlayfs' and
+            dn.get('kind', 'chunk') == 'chunk' and
+            dn.get('build-mode', 'staging') != 'bootstrap')
+
+
+def mount(dn):
+    '''Stack the artifacts installed for dn as overlayfs layers.
+
+    The sandbox itself is the upper layer, mounted over itself, so after
+    unmount() it contains only what the build wrote. If the layers can't
+    be stacked the way hardlink_all_files() would have staged them, or we
+    can't mount them, we fall back to hardlinking them.
+
+    '''
+    layers, dn['layers'] = dn.get('layers', []), []
+    if layers == []:
+        return
+
+    starttime = time.time()
+    files = stack(dn, layers)
+    if files is not None:
+        overlay = tempfile.mkdtemp()
+        os.mkdir(os.path.join(overlay, 'work'))
+        # short names for the layers, so more of them fit in the options
+        for i, (component, unpackdir) in enumerate(reversed(layers)):
+            os.symlink(unpackdir, os.path.join(overlay, str(i)))
+        options = 'lowerdir=%s,upperdir=%s,workdir=work' % (
+            ':'.join(str(i) for i in range(len(layers))), dn['sandbox'])
+        with open(dn['log'], 'a') as logfile:
+            if call(['mount', '-t', 'overlay', 'overlay', '-o', options,
+                     dn['sandbox']], cwd=overlay, stdout=logfile,
+                    stderr=logfile) == 0:
+                dn['overlay'] = overlay
+                dn['staged'] = (files, time.time() - starttime)
+                app.log(dn, 'Mounted %s layers at' % len(layers),
+                        dn['sandbox'], verbose=True)
+                return
+        app.remove_dir(overlay)
+        app.log(dn, 'WARNING: unable to mount overlayfs, see', dn['log'])
+
+    app.log(dn, 'Staging with hardlinks instead of overlayfs')
+    for component, unpackdir in layers:
+        count = utils.hardlink_all_files(unpackdir, dn['sandbox'])
+        dn['staged'] = (dn.get('staged', (0, 0))[0] + count,
+                        time.time() - starttime)
+
+
+def stack(dn, layers):
+    '''Return how many paths the stacked layers contain, or None.
+
+    We compare each artifact's list of files to find overlaps, as they
+    would be found by hardlink_all_files(). A path which is a directory in
+    one artifact and something else in another is a problem: overlayfs
+    would hide one of them, where hardlink_all_files() would follow the
+    symlink, so we return None.
+
+    '''
+    merged = {}
+    for component, unpackdir in layers:
+        types = cache.get_file_types(component)
+        if types is None:
+            return None
+        for path, kind in types.iteritems():
+            existing, name = merged.get(path, (None, None))
+            if existing is None or existing == kind == 'd':
+                merged[path] = (kind, component['name'])
+                continue
+            if 'd' in (existing, kind):
+                app.log(dn, 'WARNING: %s is a directory in only one of' %
+                        path, '%s and %s' % (name, component['name']))
+                return None
+            app.log('OVERLAPS', 'WARNING: overlap at',
+                    os.path.join(dn['sandbox'], path), verbose=True)
+            if kind == 'l':
+                app.config['new-overlaps'] += ['/' + path]
+            merged[path] = (kind, component['name'])
+    return len(merged)
+
+
+def unmount(dn):
+    ''' Unmount the layers stacked by mount(), if any. '''
+
+    if dn.get('overlay'):
+        if call(['umount', dn['sandbox']]):
+            app.log(dn, 'WARNING: sandbox is busy, detaching', dn['sandbox'])
+            call(['umount', '-l', dn['sandbox']])
+        app.remove_dir(dn.pop('overlay'))
+
+
+def restore(dn, key):
+    '''Clone the snapshot for key into dn's sandbox, if there is one.
+
+    The snapshot is cloned with hardlinks, which is much quicker than staging
+    the artifacts in it one by one again. Returns True if it worked.
+
+    '''
+    snapshot = os.path.join(app.config['tmp'], 'snapshots', key)
+    try:
+        with open(snapshot + '.json') as f:
+            info = json.load(f)
+    except (IOError, ValueError):
+        return False
+
+    starttime = time.time()
+    with open(dn['log'], 'a') as logfile:
+        if call(['cp', '-al', snapshot + '/.', dn['sandbox']],
+                stdout=logfile, stderr=logfile):
+            app.log(dn, 'WARNING: unable to clone snapshot, see', dn['log'])
+            return False
+    app.config['new-overlaps'] += info['overlaps']
+    files, seconds = dn.get('staged', (0, 0))
+    dn['staged'] = (files + info['files'], seconds + time.time() - starttime)
+    app.log(dn, 'Cloned snapshot', snapshot, verbose=True)
+    return True
+
+
+def snapshot(dn, key, overlaps):
+    ''' Keep dn's staged sandbox as the snapshot for key. '''
+
+    snapshots = os.path.join(app.config['tmp'], 'snapshots')
+    if not os.path.isdir(snapshots):
+        try:
+            os.makedirs(snapshots)
+        except OSError:
+            pass
+    try:
+        os.rename(dn['sandbox'], os.path.join(snapshots, key))
+    except OSError:
+        # another instance has made the same snapshot
+        app.remove_dir(dn['sandbox'])
+        return
+
+    # the .json is how we know the snapshot is complete
+    with tempfile.NamedTemporaryFile(dir=snapshots, delete=False) as f:
+        json.dump({'files': dn.get('staged', (0, 0))[0],
+                   'overlaps': overlaps}, f)
+    os.rename(f.name, os.path.join(snapshots, key + '.json'))
+
+
+def log_staging(dn):
+    ''' Report how many files were staged into dn's sandbox, and how fast. '''
+
+    if dn.get('staged'):
+        files, seconds = dn.pop('staged')
+        app.log(dn, 'Staged %s files in %s, %d files/sec' %
+                (files, app.duration(seconds), files / max(seconds, 0.001)))
 
 
 def ldconfig(dn):
@@ -168,12 +340,16 @@ def run_sandboxed(dn, command, env=None, allow_parallel=False):
     try:
         if not allow_parallel:
             env.pop("MAKEFLAGS", None)
+        else:
+            env['MAKEFLAGS'] = '-j%s' % resources.max_jobs(dn)
 
         app.log_env(dn['log'], env, argv_to_string(argv))
 
         with open(dn['log'], "a") as logfile:
             exit_code = 99
             try:
+                if allow_parallel:
+                    app.config['building'].increment()
                 exit_code = executor.run_sandbox_with_redirection(
                     argv, stdout=logfile, stderr=sandboxlib.STDOUT,
                     env=env, **config)
@@ -182,12 +358,19 @@ def run_sandboxed(dn, command, env=None, allow_parallel=False):
                 traceback.print_exc()
                 app.log('SANDBOX', 'ERROR: in run_sandbox_with_redirection',
                         exit_code)
+            finally:
+                if allow_parallel:
+                    app.config['building'].decrement()
 
         if exit_code != 0:
             app.log(dn, 'ERROR: command failed in directory %s:\n\n' %
                     os.getcwd(), argv_to_string(argv))
             call(['tail', '-n', '200', dn['log']])
             app.log(dn, 'ERROR: log file is at', dn['log'])
+            if app.config.get('keep-going'):
+                app.log(dn, 'Sandbox debris is at', dn['sandbox'])
+                raise app.BuildError(dn['cache'])
+            unmount(dn)
             app.log(dn, 'Sandbox debris is at', dn['sandbox'], exit=True)
     finally:
         if cur_makeflags is not None:
@@ -201,6 +384,9 @@ def run_logged(dn, cmd_list):
             app.log(dn, 'ERROR: command failed in directory %s:\n\n' %
                     os.getcwd(), argv_to_string(cmd_list))
             call(['tail', '-n', '200', dn['log']])
+            if app.config.get('keep-going'):
+                app.log(dn, 'Log file is at', dn['log'])
+                raise app.BuildError(dn['cache'])
             app.log(dn, 'Log file is at', dn['log'], exit=True)
 
 
@@ -316,7 +502,7 @@ def env_vars_for_build(dn):
 
     env['PATH'] = ':'.join(path)
     env['PREFIX'] = dn.get('prefix') or '/usr'
-    env['MAKEFLAGS'] = '-j%s' % (dn.get('max-jobs') or app.config['max-jobs'])
+    env['MAKEFLAGS'] = '-j%s' % resources.max_jobs(dn)
     env['TERM'] = 'dumb'
     env['SHELL'] = '/bin/sh'
     env['USER'] = env['USERNAME'] = env['LOGNAME'] = 'tomjon'
@@ -0,0 +1,243 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+import datetime
+import os
+import time
+
+import app
+from app import config, log
+from assembly import claim, compose
+from cache import cache_key, get_cache, rekey
+import history
+
+
+def dependencies(dn):
+    '''Return paths of the components which compose(dn) would need first.'''
+
+    deps = []
+    for it in dn.get('build-depends', []):
+        deps.append(app.defs.get(it)['path'])
+
+    for it in dn.get('contents', []):
+        item = app.defs.get(it)
+        if item.get('build-mode', 'staging') != 'bootstrap':
+            deps.append(item['path'])
+
+    def add_system_recursively(system):
+        for subsystem in system.get('subsystems', []):
+            add_system_recursively(subsystem)
+        deps.append(app.defs.get(system['path'])['path'])
+
+    for system in dn.get('systems', []):
+        add_system_recursively(system)
+
+    return deps
+
+
+def graph(target):
+    '''Return the dependency graph for target, and a build order for it.
+
+    The graph is a dict mapping each path to the paths it depends on, and
+    the order lists every path after all of its dependencies.
+
+    '''
+    nodes = {}
+    order = []
+
+    def walk(path):
+        if path in nodes:
+            return
+        nodes[path] = dependencies(app.defs.get(path))
+        for dep in nodes[path]:
+            walk(dep)
+        order.append(path)
+
+    walk(app.defs.get(target)['path'])
+    return nodes, order
+
+
+def estimator():
+    '''Return a function estimating the total time to create a component.'''
+
+    return history.estimator('staging', 'build', 'archive', 'upload')
+
+
+def priorities(nodes, order, estimate):
+    '''Return the estimated time from starting each component to the end.
+
+    This is the longest path from the component up to the target, where
+    each step takes as long as that component's previous builds did.
+    Starting components with the longest remaining path first keeps the
+    critical path (gcc, glibc, linux...) moving.
+
+    '''
+    dependents = {path: [] for path in order}
+    for path in order:
+        for dep in nodes[path]:
+            dependents[dep].append(path)
+
+    rank = {}
+    for path in reversed(order):
+        following = [rank[p] for p in dependents[path]]
+        rank[path] = estimate(app.defs.get(path)) + max(following or [0])
+    return rank
+
+
+def ready(nodes, order, done, blocked):
+    '''Return the components whose dependencies are all done.
+
+    Anything found to be cached (or unbuildable for this arch) is added to
+    done as a side effect, and anything which failed to build, or depends
+    on something which did, is added to blocked.
+
+    '''
+    result = []
+    for path in order:
+        if path in done or path in blocked:
+            continue
+        dn = app.defs.get(path)
+        if any(dep in blocked for dep in nodes[path]):
+            blocked.add(path)
+            continue
+        buildable = all(dep in done for dep in nodes[path])
+        if buildable:
+            rekey(dn)
+            if failed(dn):
+                blocked.add(path)
+                continue
+        if cache_key(dn) is False or get_cache(dn):
+            done.add(path)
+            continue
+        if buildable:
+            result.append(dn)
+    return result
+
+
+def failed(dn, mark=False):
+    '''Check (or record) that dn failed to build, for keep-going mode.'''
+
+    if not config.get('failed-dir'):
+        return False
+    marker = os.path.join(config['failed-dir'], cache_key(dn))
+    if mark:
+        open(marker, 'w').close()
+    return os.path.exists(marker)
+
+
+def eta(order, done, rank, estimate):
+    '''Log the estimated time remaining until target is complete.
+
+    We can't finish sooner than the longest remaining path, nor sooner than
+    the remaining work shared between all of the instances.
+
+    '''
+    remaining = [app.defs.get(path) for path in order if path not in done]
+    if remaining == []:
+        return
+    work = sum(estimate(dn) for dn in remaining)
+    seconds = max(max(rank[dn['path']] for dn in remaining),
+                  work / config.get('instances', 1))
+    finish = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+    log('ETA', '%s components remaining, estimated time' % len(remaining),
+        '%s, finishing at %s' % (app.duration(seconds),
+                                 finish.strftime('%Y-%m-%d %H:%M:%S')))
+
+
+def schedule(target):
+    '''Build everything needed for target, in dependency order.
+
+    Every fork runs this loop over the same graph. Each fork only composes
+    components whose dependencies are already cached, and claims them first
+    so that each ready component is handed to exactly one fork. Forks which
+    find nothing to claim wait for another fork to finish something.
+
+    Ready components are tried in order of priority, longest path first.
+
+    '''
+    target = app.defs.get(target)
+    nodes, order = graph(target)
+    estimate = estimator()
+    rank = priorities(nodes, order, estimate)
+    done = set()
+    blocked = set()
+    log(target, 'Scheduling %s components' % len(order), verbose=True)
+
+    candidates = ready(nodes, order, done, blocked)
+    eta(order, done, rank, estimate)
+    while target['path'] not in done | blocked:
+        candidates.sort(key=lambda dn: rank[dn['path']], reverse=True)
+
+        if candidates == []:
+            log(target, 'Nothing is ready to build for', target['path'],
+                exit=True)
+
+        started = False
+        for dn in candidates:
+            with claim(dn, wait=False) as claimed:
+                if not claimed:
+                    continue
+                try:
+                    compose(dn)
+                except app.BuildError:
+                    failed(dn, mark=True)
+                    blocked.add(dn['path'])
+            if dn['path'] not in blocked:
+                if not get_cache(dn):
+                    log(dn, 'No artifact after composing', cache_key(dn),
+                        exit=True)
+                done.add(dn['path'])
+            started = True
+            break
+
+        if not started:
+            wait_for_change()
+
+        candidates = ready(nodes, order, done, blocked)
+        if started:
+            eta(order, done | blocked, rank, estimate)
+
+    if blocked:
+        summary(target, order, done, blocked)
+
+
+def summary(target, order, done, blocked):
+    '''Report what failed in keep-going mode, and exit.'''
+
+    for path in order:
+        if path in blocked and failed(app.defs.get(path)):
+            log(app.defs.get(path), 'ERROR: failed to build', cache_key(path))
+    log(target, 'Skipped %s components which depend on failed builds' %
+        len([p for p in blocked if not failed(app.defs.get(p))]))
+    log(target, '%s of %s components are cached' % (len(done), len(order)))
+    log(target, 'Unable to build', target['cache'], exit=True)
+
+
+def wait_for_change(interval=0.5):
+    '''Sleep until an artifact appears or a claim is released.
+
+    Both of these events change the mtime of the relevant directory, so
+    we poll those rather than the individual lockfiles. A fork which died
+    holding a claim leaves no trace, so we give up waiting after a while.
+
+    '''
+    def mtimes():
+        return [os.stat(config[d]).st_mtime for d in ['artifacts', 'tmp']]
+
+    before = mtimes()
+    deadline = time.time() + int(config.get('timeout', 60))
+    while mtimes() == before and time.time() < deadline:
+        time.sleep(interval)
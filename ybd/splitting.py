@@ -16,7 +16,7 @@
 
 import app
 from app import config, log, chdir
-from cache import get_cache
+from cache import get_member
 import os
 import re
 import yaml
@@ -76,34 +76,32 @@ def move_required_files(dn, stratum, artifacts):
             continue
 
         try:
-            metafile = path_to_metafile(chunk)
-            with open(metafile, "r") as f:
-                filelist = []
-                metadata = yaml.safe_load(f)
-                split_metadata = {'ref': metadata.get('ref'),
-                                  'repo': metadata.get('repo'),
-                                  'products': []}
-                if config.get('artifact-version', 0) not in range(0, 1):
-                    metadata['cache'] = dn.get('cache')
-
-                for product in metadata['products']:
-                    if product['artifact'] in to_keep:
-                        filelist += product.get('components', [])
-                        # handle old artifacts still containing 'files'
-                        filelist += product.get('files', [])
-
-                        split_metadata['products'].append(product)
-
-                if split_metadata['products'] != []:
-                    split_metafile = os.path.join(baserockpath,
-                                                  os.path.basename(metafile))
-                    with open(split_metafile, "w") as f:
-                        yaml.safe_dump(split_metadata, f,
-                                       default_flow_style=False)
-                    log(dn, 'Splits split_metadata is\n', split_metadata,
-                        verbose=True)
-                    log(dn, 'Splits filelist is\n', filelist, verbose=True)
-                    copy_file_list(dn['sandbox'], dn['install'], filelist)
+            filelist = []
+            metadata = get_metadata(chunk)
+            split_metadata = {'ref': metadata.get('ref'),
+                              'repo': metadata.get('repo'),
+                              'products': []}
+            if config.get('artifact-version', 0) not in range(0, 1):
+                metadata['cache'] = dn.get('cache')
+
+            for product in metadata['products']:
+                if product['artifact'] in to_keep:
+                    filelist += product.get('components', [])
+                    # handle old artifacts still containing 'files'
+                    filelist += product.get('files', [])
+
+                    split_metadata['products'].append(product)
+
+            if split_metadata['products'] != []:
+                split_metafile = os.path.join(baserockpath,
+                                              chunk['name'] + '.meta')
+                with open(split_metafile, "w") as f:
+                    yaml.safe_dump(split_metadata, f,
+                                   default_flow_style=False)
+                log(dn, 'Splits split_metadata is\n', split_metadata,
+                    verbose=True)
+                log(dn, 'Splits filelist is\n', filelist, verbose=True)
+                copy_file_list(dn['sandbox'], dn['install'], filelist)
         except:
             import traceback
             traceback.print_exc()
@@ -135,13 +133,13 @@ def check_overlaps(dn):
 def get_metadata(dn):
     '''Load an individual .meta file
 
-    The .meta file is expected to be in the .unpacked/baserock directory of the
-    built artifact
+    The .meta file is expected to be in the baserock directory of the built
+    artifact. We only read that file, so the artifact needn't be extracted.
 
     '''
     try:
-        with open(path_to_metafile(dn), "r") as f:
-            metadata = yaml.safe_load(f)
+        metadata = yaml.safe_load(get_member(dn, os.path.join(
+            'baserock', dn['name'] + '.meta')))
         log(dn, 'Loaded metadata', dn['path'], verbose=True)
         return metadata
     except:
@@ -149,13 +147,6 @@ def get_metadata(dn):
         return None
 
 
-def path_to_metafile(dn):
-    ''' Return the path to metadata file for dn. '''
-
-    return os.path.join(get_cache(dn) + '.unpacked', 'baserock',
-                        dn['name'] + '.meta')
-
-
 def compile_rules(dn):
     regexps = []
     splits = {}
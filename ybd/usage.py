@@ -0,0 +1,159 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Keep track of the size and last use of each artifact.
+
+The usage index is a small sqlite database in the artifacts directory, with
+one row per artifact, so cull() can pick the least recently used artifacts
+without having to stat everything in the cache.
+
+'''
+
+import os
+import sqlite3
+import stat
+import time
+
+import app
+
+
+def connect():
+    db = sqlite3.connect(os.path.join(app.config['artifacts'], '.usage'),
+                         timeout=int(app.config.get('timeout', 60)))
+    db.execute('CREATE TABLE IF NOT EXISTS usage '
+               '(cache TEXT PRIMARY KEY, kind TEXT, size INTEGER, '
+               'unpacked INTEGER, used REAL)')
+    db.execute('CREATE INDEX IF NOT EXISTS used ON usage (used)')
+    return db
+
+
+def du(path):
+    '''Return the total size in bytes of the files under path.
+
+    With deduplicate-artifacts, a file whose blob is linked from other
+    artifacts too isn't counted, since removing path wouldn't free it.
+
+    '''
+    links = 2 if app.config.get('deduplicate-artifacts') else None
+    total = 0
+    for dirname, subdirs, files in os.walk(path):
+        for name in subdirs + files:
+            try:
+                st = os.lstat(os.path.join(dirname, name))
+            except OSError:
+                continue
+            if links and stat.S_ISREG(st.st_mode) and st.st_nlink > links:
+                continue
+            total += st.st_size
+    return total
+
+
+def sizes(path):
+    '''Return the sizes of an artifact directory, and of its .unpacked.'''
+
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size, 0
+    size, unpacked = 0, 0
+    for name in os.listdir(path):
+        if name.endswith('.unpacked'):
+            unpacked += du(os.path.join(path, name))
+        else:
+            size += os.lstat(os.path.join(path, name)).st_size
+    return size, unpacked
+
+
+def execute(statement, *rows):
+    try:
+        db = connect()
+        with db:
+            db.executemany(statement, rows)
+        db.close()
+    except sqlite3.Error as e:
+        app.log('USAGE', 'WARNING: unable to update artifact usage:', e)
+
+
+def record(dn, path):
+    ''' Add the artifact for dn at path to the index. '''
+
+    size, unpacked = sizes(path)
+    execute('INSERT OR REPLACE INTO usage VALUES (?, ?, ?, ?, ?)',
+            (dn['cache'], dn.get('kind', 'chunk'), size, unpacked,
+             time.time()))
+
+
+_touched = {}
+_flushed = time.time()
+
+
+def touch(key):
+    ''' Note that the artifact for key has been used.
+
+    This happens for every artifact we look at, so we only keep the time
+    here, and flush() writes them all to the index together.
+
+    '''
+    _touched[key] = time.time()
+    if time.time() - _flushed > 60:
+        flush()
+
+
+def flush():
+    ''' Write the times of the artifacts touched since last time. '''
+
+    global _flushed
+    _flushed = time.time()
+    if _touched:
+        execute('UPDATE usage SET used = ? WHERE cache = ?',
+                *[(used, key) for key, used in _touched.items()])
+        _touched.clear()
+
+
+def unpacked(key, path):
+    ''' Note that the artifact for key has (re)gained its .unpacked dir. '''
+
+    execute('UPDATE usage SET unpacked = ? WHERE cache = ?', (du(path), key))
+
+
+def sync(artifact_dir):
+    '''Make the index match the artifacts which are actually on disk.
+
+    Only artifacts which the index doesn't know about yet (eg from older
+    versions of ybd, or copied in by hand) need to be measured, so after
+    the first time this is just a listdir.
+
+    '''
+    flush()
+    keys = set(k for k in os.listdir(artifact_dir) if not k.startswith('.'))
+    db = connect()
+    known = set(k for k, in db.execute('SELECT cache FROM usage'))
+    missing = keys - known
+    if missing:
+        app.log('SETUP', 'Indexing %s artifacts in' % len(missing),
+                artifact_dir)
+    rows = []
+    for key in missing:
+        path = os.path.join(artifact_dir, key)
+        try:
+            size, unpacked = sizes(path)
+            rows.append((key, None, size, unpacked, os.stat(path).st_mtime))
+        except OSError:
+            pass
+    with db:
+        db.executemany('INSERT OR REPLACE INTO usage VALUES (?, ?, ?, ?, ?)',
+                       rows)
+        db.executemany('DELETE FROM usage WHERE cache = ?',
+                       [(key,) for key in known - keys])
+    return db
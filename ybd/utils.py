@@ -15,8 +15,14 @@
 # =*= License: GPL-2 =*=
 
 import re
+import ctypes
+import fcntl
+import functools
 import gzip
+import hashlib
+import json
 import tarfile
+import threading
 import contextlib
 import os
 import shutil
@@ -26,7 +32,15 @@ from fs.osfs import OSFS
 from fs.multifs import MultiFS
 import calendar
 import app
-from subprocess import check_call, check_output
+from subprocess import call, check_call, check_output, PIPE, Popen
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # The magic number for timestamps: 2011-11-11 11:11:11
 default_magic_timestamp = calendar.timegm([2011, 11, 11, 11, 11, 11])
@@ -111,13 +125,53 @@ def relative_symlink_target(root, symlink, target):
         return target
 
 
+# (pid, pool) of the threads which stage files and query gits for us
+_file_pool = (None, None)
+
+
+def thread_pool():
+    '''Return this instance's pool of threads, shared between callers.'''
+
+    global _file_pool
+    # threads don't survive fork(), so each instance needs its own pool.
+    # python2's pool takes ~0.1s to shut down, so we keep it for next time
+    if _file_pool[0] != os.getpid():
+        _file_pool = (os.getpid(), ThreadPool(8))
+    return _file_pool[1]
+
+
+def copy_all_files(srcpath, destpath):
+    '''Copy every file in the source path to the destination.
+
+    If an exception is raised, the staging-area is indeterminate.
+
+    '''
+    return _process_tree(destpath, srcpath, destpath, copy_file)
+
+
 def hardlink_all_files(srcpath, destpath):
     '''Hardlink every file in the path to the staging-area
 
     If an exception is raised, the staging-area is indeterminate.
 
     '''
-    _process_tree(destpath, srcpath, destpath, os.link)
+    return _process_tree(destpath, srcpath, destpath, os.link)
+
+
+def _process_tree(root, srcpath, destpath, actionfunc):
+    '''Stage srcpath at destpath, calling actionfunc(src, dest) for files.
+
+    We walk the tree in this thread, creating directories and symlinks,
+    while a pool of threads deals with the files. Returns the number of
+    entries staged.
+
+    '''
+    results = []
+    count = _stage_directory(root, srcpath, destpath,
+                             os.path.realpath(destpath), actionfunc, results)
+    for result in results:
+        result.get()
+    return count
 
 
 def _ensure_real_directory(root, destpath):
@@ -148,83 +202,259 @@ def _ensure_real_directory(root, destpath):
     return realpath
 
 
-def _process_tree(root, srcpath, destpath, actionfunc):
-    if os.path.lexists(destpath):
-        app.log('OVERLAPS', 'WARNING: overlap at', destpath, verbose=True)
+def _stage_directory(root, srcpath, destpath, realpath, actionfunc, results):
+    '''Stage the contents of srcpath at destpath, which is at realpath.'''
+
+    count = 0
+    files = []
+    for entry in _scandir(srcpath):
+        dest = os.path.join(destpath, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            real = _stage_real_directory(root, dest,
+                                         os.path.join(realpath, entry.name))
+            count += _stage_directory(root, entry.path, dest, real,
+                                      actionfunc, results)
+        elif entry.is_symlink():
+            _stage_symlink(root, entry.path, dest)
+        elif entry.is_file(follow_symlinks=False):
+            files.append((entry.path, dest))
+        else:
+            file_stat = entry.stat(follow_symlinks=False)
+            if stat.S_ISCHR(file_stat.st_mode) or \
+                    stat.S_ISBLK(file_stat.st_mode):
+                # Block or character device. Put st_dev in a mknod.
+                if os.path.lexists(dest):
+                    os.remove(dest)
+                os.mknod(dest, file_stat.st_mode, file_stat.st_rdev)
+                os.chmod(dest, file_stat.st_mode)
+            else:
+                raise IOError('Cannot stage %s, unsupported type' %
+                              entry.path)
+        count += 1
 
-    file_stat = os.lstat(srcpath)
-    mode = file_stat.st_mode
+    if files:
+        results.append(thread_pool().map_async(
+            functools.partial(_stage_file, actionfunc), files))
+    return count
 
-    if stat.S_ISDIR(mode):
-        # Ensure directory exists in destination, then recurse.
 
-        # os.path.lexists() returns True for broken symlinks
-        #
-        if not os.path.lexists(destpath):
-            os.makedirs(destpath)
+def _stage_real_directory(root, destpath, realpath):
+    '''Make sure destpath is a directory, and return its real path.
+
+    realpath is where destpath would be if it is not a symlink, so we only
+    need to resolve the real path (which means an lstat for every level)
+    for symlinks.
 
-        # This creates the realpath safely, the above line can
-        # probably be removed
+    '''
+    try:
+        os.mkdir(destpath)
+        return realpath
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    if os.path.islink(destpath):
         realpath = _ensure_real_directory(root, destpath)
 
-        # At this point we know it exists, stat() should not fail here
-        dest_stat = os.stat(realpath)
-
-        if not stat.S_ISDIR(dest_stat.st_mode):
-            raise IOError('Destination not a directory: source has %s'
-                          ' destination has %s' % (srcpath, destpath))
-
-        for entry in os.listdir(srcpath):
-            _process_tree(root,
-                          os.path.join(srcpath, entry),
-                          os.path.join(destpath, entry),
-                          actionfunc)
-    elif stat.S_ISLNK(mode):
-        # Copy the symlink.
-        if os.path.lexists(destpath):
-            import re
-            path = re.search('/.*$', re.search('tmp[^/]+/.*$',
-                             destpath).group(0)).group(0)
-            app.config['new-overlaps'] += [path]
-
-            # Try to remove anything that is in the way, but issue
-            # a warning instead if it removes a non empty directory
+    if not os.path.isdir(realpath):
+        raise IOError('Destination not a directory: %s' % destpath)
+    return realpath
+
+
+def _stage_symlink(root, srcpath, destpath):
+    # Copy the symlink.
+    if os.path.lexists(destpath):
+        import re
+        path = re.search('/.*$', re.search('tmp[^/]+/.*$',
+                         destpath).group(0)).group(0)
+        app.config['new-overlaps'] += [path]
+
+        # Try to remove anything that is in the way, but issue
+        # a warning instead if it removes a non empty directory
+        try:
+            os.unlink(destpath)
+        except OSError as e:
+            if e.errno != errno.EISDIR:
+                raise
+
             try:
-                os.unlink(destpath)
+                os.rmdir(destpath)
             except OSError as e:
-                if e.errno != errno.EISDIR:
-                    raise
+                if e.errno == errno.ENOTEMPTY:
+                    app.log('UTILS',
+                            'WARNING: Ignoring symlink "' + destpath +
+                            '" which purges non-empty directory')
+                    return
 
-                try:
-                    os.rmdir(destpath)
-                except OSError as e:
-                    if e.errno == errno.ENOTEMPTY:
-                        app.log('UTILS',
-                                'WARNING: Ignoring symlink "' + destpath +
-                                '" which purges non-empty directory')
-                        return
-
-        # Ensure that the symlink target is a relative path
-        target = os.readlink(srcpath)
-        target = relative_symlink_target(root, destpath, target)
-        os.symlink(target, destpath)
-
-    elif stat.S_ISREG(mode):
-        # Process the file.
-        if os.path.lexists(destpath):
-            os.remove(destpath)
+    # Ensure that the symlink target is a relative path
+    target = os.readlink(srcpath)
+    target = relative_symlink_target(root, destpath, target)
+    os.symlink(target, destpath)
+
+
+def _stage_file(actionfunc, paths):
+    srcpath, destpath = paths
+    try:
+        actionfunc(srcpath, destpath)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        app.log('OVERLAPS', 'WARNING: overlap at', destpath, verbose=True)
+        os.remove(destpath)
         actionfunc(srcpath, destpath)
 
-    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
-        # Block or character device. Put contents of st_dev in a mknod.
-        if os.path.lexists(destpath):
-            os.remove(destpath)
-        os.mknod(destpath, file_stat.st_mode, file_stat.st_rdev)
-        os.chmod(destpath, file_stat.st_mode)
 
-    else:
-        # Unsupported type.
-        raise IOError('Cannot stage %s, unsupported type' % srcpath)
+class _DirEntry(object):
+    '''Enough of os.scandir()'s DirEntry, for when we don't have scandir.'''
+
+    def __init__(self, dirname, name):
+        self.name = name
+        self.path = os.path.join(dirname, name)
+        self._stat = None
+
+    def stat(self, follow_symlinks=False):
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
+
+    def is_dir(self, follow_symlinks=False):
+        return stat.S_ISDIR(self.stat().st_mode)
+
+    def is_file(self, follow_symlinks=False):
+        return stat.S_ISREG(self.stat().st_mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat().st_mode)
+
+
+def _scandir(path):
+    '''Return the entries in path. scandir avoids most of the stat calls.'''
+
+    if scandir is not None:
+        return scandir(path)
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+def file_types(path, types=None, prefix=''):
+    '''Return a dict of everything under path, and its type.
+
+    The type is 'd' for a directory, 'l' for a symlink and 'f' for anything
+    else. The names are relative to path.
+
+    '''
+    if types is None:
+        types = {}
+    for entry in _scandir(path):
+        name = os.path.join(prefix, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            types[name] = 'd'
+            file_types(entry.path, types, name)
+        elif entry.is_symlink():
+            types[name] = 'l'
+        else:
+            types[name] = 'f'
+    return types
+
+
+# ioctl to make a reflink, from linux/fs.h
+FICLONE = 0x40049409
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.sendfile.restype = ctypes.c_ssize_t
+if hasattr(_libc, 'copy_file_range'):
+    _libc.copy_file_range.restype = ctypes.c_ssize_t
+
+# (pid, set) of the ways of copying which copy_file() has found don't work,
+# as (method, (source device, destination device)), or (method, None) for
+# any devices
+_unsupported = (None, None)
+
+
+def unsupported_copies():
+    '''Return the ways of copying which this instance has found don't work.'''
+
+    global _unsupported
+    # each instance finds out for itself, rather than trust what its parent
+    # found before fork(), eg with other filesystems mounted
+    if _unsupported[0] != os.getpid():
+        _unsupported = (os.getpid(), set())
+    return _unsupported[1]
+
+
+def copy_file(srcpath, destpath):
+    '''Copy a file, with its permissions and times, as quickly as we can.
+
+    We try a reflink first, which shares the data until one of the files
+    is changed (on btrfs and xfs, for example), then copy_file_range() and
+    sendfile(), which copy in the kernel, and finally read and write. Like
+    os.link(), this fails with EEXIST if destpath exists.
+
+    '''
+    infd = os.open(srcpath, os.O_RDONLY)
+    try:
+        outfd = os.open(destpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            st = os.fstat(infd)
+            devices = (st.st_dev, os.fstat(outfd).st_dev)
+            unsupported = unsupported_copies()
+            for method in [_reflink, _copy_file_range, _sendfile]:
+                if {(method, None), (method, devices)} & unsupported:
+                    continue
+                try:
+                    method(infd, outfd, st.st_size)
+                    break
+                except (IOError, OSError) as e:
+                    if e.errno not in [errno.EINVAL, errno.ENOSYS,
+                                       errno.ENOTTY, errno.EOPNOTSUPP,
+                                       errno.EXDEV]:
+                        raise
+                    # only a missing syscall means the method never works,
+                    # other errors depend on the filesystems
+                    unsupported.add((method, None if e.errno == errno.ENOSYS
+                                     else devices))
+                    os.lseek(infd, 0, os.SEEK_SET)
+                    os.lseek(outfd, 0, os.SEEK_SET)
+                    os.ftruncate(outfd, 0)
+            else:
+                _copy(infd, outfd)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+    shutil.copystat(srcpath, destpath)
+
+
+def _reflink(infd, outfd, size):
+    fcntl.ioctl(outfd, FICLONE, infd)
+
+
+def _kernel_copy(function, size):
+    while size > 0:
+        copied = function(min(size, 1 << 30))
+        if copied < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        if copied == 0:
+            break
+        size -= copied
+
+
+def _copy_file_range(infd, outfd, size):
+    if not hasattr(_libc, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'no copy_file_range in libc')
+    _kernel_copy(lambda n: _libc.copy_file_range(
+        infd, None, outfd, None, ctypes.c_size_t(n), 0), size)
+
+
+def _sendfile(infd, outfd, size):
+    _kernel_copy(lambda n: _libc.sendfile(
+        outfd, infd, None, ctypes.c_size_t(n)), size)
+
+
+def _copy(infd, outfd):
+    for data in iter(lambda: os.read(infd, 1024 * 1024 * 4), b''):
+        while data:
+            data = data[os.write(outfd, data):]
 
 
 def copy_file_list(srcpath, destpath, filelist):
@@ -233,14 +463,7 @@ def copy_file_list(srcpath, destpath, filelist):
     If an exception is raised, the staging-area is indeterminate.
 
     '''
-
-    def _copyfun(inpath, outpath):
-        with open(inpath, "r") as infh:
-            with open(outpath, "w") as outfh:
-                shutil.copyfileobj(infh, outfh, 1024*1024*4)
-        shutil.copystat(inpath, outpath)
-
-    _process_list(srcpath, destpath, filelist, _copyfun)
+    _process_list(srcpath, destpath, filelist, copy_file)
 
 
 def hardlink_file_list(srcpath, destpath, filelist):
@@ -277,6 +500,7 @@ def _copy_directories(srcdir, destdir, target):
 
 def _process_list(srcdir, destdir, filelist, actionfunc):
 
+    files = []
     for path in sorted(filelist):
         srcpath = os.path.join(srcdir, path).encode('UTF-8')
         destpath = os.path.join(destdir, path).encode('UTF-8')
@@ -327,10 +551,10 @@ def _process_list(srcdir, destdir, filelist, actionfunc):
             os.symlink(target, destpath)
 
         elif stat.S_ISREG(mode):
-            # Process the file.
+            # Process the file, in the pool.
             if os.path.lexists(destpath):
                 os.remove(destpath)
-            actionfunc(srcpath, destpath)
+            files.append((srcpath, destpath))
 
         elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
             # Block or character device. Put contents of st_dev in a mknod.
@@ -344,8 +568,11 @@ def _process_list(srcdir, destdir, filelist, actionfunc):
             raise IOError('Cannot extract %s into staging-area. Unsupported'
                           ' type.' % srcpath)
 
+    thread_pool().map(functools.partial(_stage_file, actionfunc), files)
 
-def make_deterministic_gztar_archive(base_name, root_dir, time=1321009871.0):
+
+def make_deterministic_gztar_archive(base_name, root_dir, time=1321009871.0,
+                                     members=None, checksum=None):
     '''Make a gzipped tar archive of contents of 'root_dir'.
 
     This function takes extra steps to ensure the output is deterministic,
@@ -363,25 +590,252 @@ def make_deterministic_gztar_archive(base_name, root_dir, time=1321009871.0):
     # filename of the tarfile in the gzip header. So we have to reimplement
     # shutil.make_archive().
 
-    def add_directory_to_tarfile(f_tar, dir_name, dir_arcname):
-        for filename in sorted(os.listdir(dir_name)):
-            name = os.path.join(dir_name, filename)
-            arcname = os.path.join(dir_arcname, filename)
-
-            f_tar.add(name=name, arcname=arcname, recursive=False)
-
-            if os.path.isdir(name) and not os.path.islink(name):
-                add_directory_to_tarfile(f_tar, name, arcname)
-
     with open(base_name + '.tar.gz', 'wb') as f:
+        if checksum:
+            f = HashingFile(f, checksum)
         gzip_context = gzip.GzipFile(
             filename='', mode='wb', fileobj=f, mtime=time)
         with gzip_context as f_gzip:
             with tarfile.TarFile(mode='w', fileobj=f_gzip) as f_tar:
-                add_directory_to_tarfile(f_tar, root_dir, '.')
+                _add_directory_to_tarfile(f_tar, root_dir, '.', members)
+
+
+def _add_directory_to_tarfile(f_tar, dir_name, dir_arcname, members=None):
+    for filename in sorted(os.listdir(dir_name)):
+        name = os.path.join(dir_name, filename)
+        arcname = os.path.join(dir_arcname, filename)
+
+        f_tar.add(name=name, arcname=arcname, recursive=False)
+        if members is not None:
+            member = f_tar.members[-1]
+            if member.isfile():
+                # the data is the last thing written, padded to a whole block
+                size = member.size
+                blocks = (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+                offset = f_tar.offset - blocks * tarfile.BLOCKSIZE
+                members[os.path.normpath(arcname)] = [offset, size]
+            else:
+                add_link_member(members, member)
+
+        if os.path.isdir(name) and not os.path.islink(name):
+            _add_directory_to_tarfile(f_tar, name, arcname, members)
+
+
+# Commands to compress to stdout, using all cores, without adding names or
+# timestamps. The output is deterministic for a given version of the tool.
+compressors = {
+    'pigz': ['pigz', '--no-name', '--no-time', '-c'],
+    'zstd': ['zstd', '-q', '-T0', '-c'],
+}
+
+
+class HashingFile(object):
+    '''Wrap a file which is being written, to update checksum as we go.'''
+
+    def __init__(self, f, checksum):
+        self.f = f
+        self.checksum = checksum
+        self.offset = 0
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.f.write(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        self.f.flush()
+
+
+def make_deterministic_archive(filename, root_dir, compression='gzip',
+                               checksum=None):
+    '''Make a compressed tar archive of contents of 'root_dir' at filename.
+
+    With the default 'gzip' compression this is the same as
+    make_deterministic_gztar_archive(). For 'pigz' or 'zstd' the tar stream
+    is piped through the external tool, which compresses on all cores.
 
+    The offset and size of each file in the tar stream are written to
+    filename.members, so that read_member() can find them later. If given,
+    checksum (a hashlib object) is updated with the archive as it's written.
 
-def make_deterministic_tar_archive(base_name, root):
+    '''
+    members = {}
+    if compression == 'gzip':
+        make_deterministic_gztar_archive(filename, root_dir, members=members,
+                                         checksum=checksum)
+        shutil.move(filename + '.tar.gz', filename)
+        write_members(filename, members)
+        return
+
+    if compression not in compressors:
+        app.log('ARCHIVE', 'ERROR: unknown artifact-compression', compression,
+                exit=True)
+    with open(filename, 'wb') as f:
+        try:
+            compressor = Popen(compressors[compression], stdin=PIPE,
+                               stdout=PIPE if checksum else f)
+        except OSError:
+            app.log('ARCHIVE', 'ERROR: unable to run', compression, exit=True)
+        if checksum:
+            # copy the compressed output to f ourselves, to hash it
+            out = HashingFile(f, checksum)
+            copier = threading.Thread(target=shutil.copyfileobj,
+                                      args=(compressor.stdout, out,
+                                            1024 * 1024))
+            copier.start()
+        with tarfile.open(mode='w|', fileobj=compressor.stdin) as f_tar:
+            _add_directory_to_tarfile(f_tar, root_dir, '.', members)
+        compressor.stdin.close()
+        if checksum:
+            copier.join()
+        if compressor.wait():
+            app.log('ARCHIVE', 'ERROR: %s failed for' % compression, filename,
+                    exit=True)
+    write_members(filename, members)
+
+
+def add_link_member(members, member):
+    '''Index a hardlink member at the data of the file it links to.
+
+    tarfile writes the data for a hardlinked file once, and any other names
+    for it as LNKTYPE members, which come later in the archive.
+
+    '''
+    if member.islnk():
+        target = members.get(os.path.normpath(member.linkname))
+        if target:
+            members[os.path.normpath(member.name)] = target
+
+
+def write_members(filename, members):
+    with open(filename + '.members', 'w') as f:
+        json.dump(members, f, sort_keys=True)
+
+
+def tar_members(filename):
+    '''Return the offset and size of each file in an archive, or None.
+
+    This reads through the whole archive (without extracting it), so it
+    also checks that the archive is valid.
+
+    '''
+    members = {}
+    with open(filename, 'rb') as f:
+        command = decompressor(filename)
+        if command:
+            decompress = Popen(command, stdin=f, stdout=PIPE)
+            stream = decompress.stdout
+        else:
+            stream = f
+        try:
+            with tarfile.open(mode='r|', fileobj=stream) as f_tar:
+                for member in f_tar:
+                    if member.isfile():
+                        members[os.path.normpath(member.name)] = [
+                            member.offset_data, member.size]
+                    else:
+                        add_link_member(members, member)
+        except tarfile.TarError:
+            members = None
+        if command:
+            stream.close()
+            if decompress.wait():
+                members = None
+    return members
+
+
+def read_member(filename, offset, size):
+    '''Return size bytes from offset in the tar stream of an archive.'''
+
+    return read_members(filename, [(offset, size)])[0]
+
+
+def read_members(filename, extents):
+    '''Return the data for each (offset, size) in the tar stream of an archive.
+
+    A compressed archive can't be seeked, so we have to decompress it from
+    the start up to the last offset wanted, which costs about as much as
+    reading the archive up to there. So when several members are wanted
+    from one archive, ask for them together, to read it in a single pass.
+
+    '''
+    data = [''] * len(extents)
+    if not extents:
+        return data
+    with open(filename, 'rb') as f:
+        command = decompressor(filename)
+        if command is None:
+            for i, (offset, size) in enumerate(extents):
+                f.seek(offset)
+                data[i] = f.read(size)
+            return data
+        with open(os.devnull, 'w') as fnull:
+            decompress = Popen(command, stdin=f, stdout=PIPE, stderr=fnull)
+        position = 0
+        last = None
+        for i in sorted(range(len(extents)), key=lambda i: extents[i]):
+            offset, size = extents[i]
+            if last is not None and extents[last] == extents[i]:
+                # another name for the same file, eg a hardlink
+                data[i] = data[last]
+                continue
+            if offset < position:
+                continue
+            while position < offset:
+                skipped = decompress.stdout.read(
+                    min(offset - position, 1024 * 1024))
+                if not skipped:
+                    break
+                position += len(skipped)
+            if position != offset:
+                break
+            data[i] = decompress.stdout.read(size)
+            position += len(data[i])
+            last = i
+        decompress.stdout.close()
+        decompress.kill()
+        decompress.wait()
+        return data
+
+
+def decompressor(filename):
+    '''Return a command to decompress filename to stdout, or None.
+
+    The format is detected from the file itself, so any artifact can be
+    read whatever artifact-compression was set when it was made.
+
+    '''
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    if magic[:2] == b'\x1f\x8b':
+        return ['gzip', '-dc']
+    if magic == b'\x28\xb5\x2f\xfd':
+        return ['zstd', '-q', '-dc']
+    return None
+
+
+def untar(filename, directory, args=['x']):
+    '''Run tar on an archive, which may be compressed. Returns the exit code.
+
+    By default the archive is extracted into directory; args=['t'] just
+    checks that it can be read.
+
+    '''
+    command = ['tar'] + args + ['-f', '-', '--directory', directory]
+    with open(filename, 'rb') as f, open(os.devnull, 'w') as fnull:
+        stdout = fnull if 't' in args else None
+        if decompressor(filename) is None:
+            return call(command, stdin=f, stdout=stdout)
+        decompress = Popen(decompressor(filename), stdin=f, stdout=PIPE)
+        status = call(command, stdin=decompress.stdout, stdout=stdout)
+        decompress.stdout.close()
+        return decompress.wait() or status
+
+
+def make_deterministic_tar_archive(base_name, root, checksum=None):
     '''Make a tar archive of contents of 'root_dir'.
 
     This function takes extra steps to make the output more deterministic,
@@ -396,6 +850,8 @@ def make_deterministic_tar_archive(base_name, root):
     '''
 
     with app.chdir(root), open(base_name + '.tar', 'wb') as f:
+        if checksum:
+            f = HashingFile(f, checksum)
         with tarfile.TarFile(mode='w', fileobj=f) as f_tar:
             directories = [d[0] for d in os.walk('.')]
             for d in sorted(directories):
@@ -428,6 +884,33 @@ def find_extensions():
     return _find_extensions(paths)
 
 
+def tree_hash(root, exclude=[]):
+    '''Return a sha256 of the names, modes and contents of a directory tree.
+
+    Top-level entries named in exclude are ignored. Timestamps and owners
+    are ignored too, so the hash only changes if the files do.
+
+    '''
+    checksum = hashlib.sha256()
+    for dirname, subdirs, files in os.walk(root):
+        if dirname == root:
+            subdirs[:] = [d for d in subdirs if d not in exclude]
+            files = [f for f in files if f not in exclude]
+        subdirs.sort()
+        for name in sorted(subdirs + files):
+            path = os.path.join(dirname, name)
+            mode = os.lstat(path).st_mode
+            checksum.update('%s %o\0' % (os.path.relpath(path, root), mode))
+            if stat.S_ISLNK(mode):
+                checksum.update(os.readlink(path))
+            elif stat.S_ISREG(mode):
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b''):
+                        checksum.update(block)
+            checksum.update('\0')
+    return checksum.hexdigest()
+
+
 def sorted_ls(path):
     def mtime(f):
         return os.stat(os.path.join(path, f)).st_mtime